@@ -0,0 +1,46 @@
+"""
+Compares the encode time and output size of the output formats supported by the
+SDXL photon's "run" endpoint. Run it with an image generated by the photon, e.g.
+
+    python benchmark_encoding.py assets/txt2img.png
+
+Encoding only depends on Pillow, so this does not need a GPU or the models.
+"""
+
+from io import BytesIO
+import sys
+import time
+
+from PIL import Image
+
+
+# (label, arguments passed to Image.save), mirroring SDXL._encoding.
+ENCODINGS = [
+    ("png, compress_level=9", dict(format="PNG", compress_level=9)),
+    ("png, compress_level=6 (default)", dict(format="PNG", compress_level=6)),
+    ("png, compress_level=1", dict(format="PNG", compress_level=1)),
+    ("webp, quality=90", dict(format="WEBP", quality=90)),
+    ("webp, quality=75", dict(format="WEBP", quality=75)),
+    ("jpeg, quality=90", dict(format="JPEG", quality=90)),
+    ("jpeg, quality=75", dict(format="JPEG", quality=75)),
+]
+
+
+def benchmark(image, encoding, repeat=10):
+    times = []
+    for _ in range(repeat):
+        img_io = BytesIO()
+        start = time.perf_counter()
+        image.save(img_io, **encoding)
+        times.append(time.perf_counter() - start)
+    return min(times), len(img_io.getvalue())
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "assets/txt2img.png"
+    image = Image.open(path).convert("RGB")
+    print(f"Image: {path}, {image.width}x{image.height}")
+    print(f"{'encoding':<32} {'time (ms)':>10} {'size (KB)':>10}")
+    for label, encoding in ENCODINGS:
+        seconds, size = benchmark(image, encoding)
+        print(f"{label:<32} {seconds * 1000:>10.1f} {size / 1024:>10.1f}")
@@ -0,0 +1,89 @@
+"""
+Exercises the request scheduling of the SDXL photon on CPU, with the stand-in
+pipeline (see _FakePipeline in sdxl.py) instead of the models. Run it next to
+sdxl.py with
+
+    python check_scheduling.py
+
+It checks that concurrent "run" requests are coalesced into batched pipeline
+calls, and that each request gets back the same image as when it runs alone.
+The stand-in sleeps in proportion to the cost of a request, which is what the
+admission controller accounts for, so it also checks that requests over the
+cost budget queue up, that a request that cannot start within its deadline is
+rejected, and that the gradio UI is admitted like the handlers.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+os.environ["FAKE_PIPELINE"] = "true"
+os.environ.setdefault("PRELOAD_REFINER", "false")
+# Seeded results are cached, which would hide the second round of requests.
+os.environ["RESULT_CACHE_MB"] = "0"
+# Room for a batch of 512x512 images, but not for two 1024x1024 ones.
+os.environ["ADMISSION_MAX_COST"] = "120"
+
+from fastapi import HTTPException  # noqa: E402
+
+from sdxl import SDXL  # noqa: E402
+
+
+def check_batching(photon):
+    specs = [
+        dict(
+            prompt=f"prompt {i % 3}",
+            seed=i,
+            use_refiner=i % 2 == 0,
+            width=512,
+            height=512,
+        )
+        for i in range(8)
+    ]
+    # Unbatched references, one request at a time.
+    expected = [photon.run(**spec).body for spec in specs]
+    calls = photon._base_stats.to_dict()["calls"]
+    with ThreadPoolExecutor(len(specs)) as pool:
+        responses = list(pool.map(lambda spec: photon.run(**spec), specs))
+    batched_calls = photon._base_stats.to_dict()["calls"] - calls
+    assert [r.body for r in responses] == expected, "images went to the wrong request"
+    # Requests with and without the refiner cannot share a batch.
+    assert batched_calls < len(specs), f"{batched_calls} calls for {len(specs)}"
+    print(f"batching: {len(specs)} concurrent requests in {batched_calls} base calls")
+
+
+def check_admission(photon):
+    # A 100 step 1024x1024 image costs ~105, so a second request has to wait.
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(photon.run, prompt="first", num_inference_steps=100)
+        time.sleep(0.02)
+        second = pool.submit(photon.run, prompt="second")
+        queue_time = float(second.result().headers["X-Queue-Time"])
+        compute_time = float(first.result().headers["X-Compute-Time"])
+    assert queue_time > compute_time / 2, (queue_time, compute_time)
+    print(f"admission: waited {queue_time:.2f}s for a {compute_time:.2f}s request")
+
+    with ThreadPoolExecutor(1) as pool:
+        first = pool.submit(photon.run, prompt="first", num_inference_steps=100)
+        time.sleep(0.02)
+        try:
+            photon.run(prompt="second", deadline=0.001)
+        except HTTPException as e:
+            assert e.status_code == 503, e.status_code
+            print(f"admission: rejected with {e.detail}")
+        else:
+            raise AssertionError("a request past its deadline was admitted")
+        first.result()
+
+    admitted = photon._admission.stats()["admitted"]
+    images = photon._run("ui", None, 512, 512, 5.0, 2, 1, 10, 0.8, True)
+    assert len(images) == 2
+    assert photon._admission.stats()["admitted"] == admitted + 1
+    print("admission: the gradio UI is admitted like the handlers")
+
+
+if __name__ == "__main__":
+    # The photon runs init on the first handler call.
+    photon = SDXL()
+    check_batching(photon)
+    check_admission(photon)
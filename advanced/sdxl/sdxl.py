@@ -1,11 +1,467 @@
+from collections import deque, OrderedDict
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
 from io import BytesIO
-from typing import Optional
+import json
+import math
+import os
+from queue import Queue
+from threading import Condition, Event, Lock, Thread
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+import uuid
+import zipfile
 
 from diffusers import DiffusionPipeline
+from fastapi.responses import Response
 import gradio as gr
+from PIL import Image
 import torch
 
-from leptonai.photon import Photon, PNGResponse
+from leptonai.photon import HTTPException, Photon, StreamingResponse
+from loguru import logger
+
+
+class _MicroBatcher:
+    """
+    Coalesces generation requests that arrive close together into a single
+    pipeline call.
+
+    Requests are grouped by ``key_fn(spec)``: only specs with the same key can
+    share a batch. A group is flushed as soon as it holds ``max_batch_size``
+    specs, or when its oldest spec has waited for ``window`` seconds. ``run_fn``
+    receives a list of (spec, future) pairs and is responsible for resolving the
+    futures, possibly later from another thread. It does not need to know anything
+    about diffusers, so the scheduling logic can be exercised with any stand-in
+    callable.
+    """
+
+    def __init__(self, run_fn, key_fn, max_batch_size: int, window: float):
+        self._run_fn = run_fn
+        self._key_fn = key_fn
+        self._max_batch_size = max(1, max_batch_size)
+        self._window = max(0.0, window)
+        # key -> list of (spec, future, arrival time), in arrival order.
+        self._pending = OrderedDict()
+        self._cv = Condition()
+        Thread(target=self._loop, daemon=True).start()
+
+    def pending(self) -> int:
+        with self._cv:
+            return sum(len(items) for items in self._pending.values())
+
+    def submit(self, spec) -> Future:
+        future = Future()
+        with self._cv:
+            self._pending.setdefault(self._key_fn(spec), []).append(
+                (spec, future, time.time())
+            )
+            self._cv.notify()
+        return future
+
+    def _next_batch(self):
+        with self._cv:
+            while True:
+                now = time.time()
+                timeout = None
+                for key, items in self._pending.items():
+                    deadline = items[0][2] + self._window
+                    if len(items) >= self._max_batch_size or now >= deadline:
+                        batch = items[: self._max_batch_size]
+                        if len(items) > self._max_batch_size:
+                            self._pending[key] = items[self._max_batch_size :]
+                        else:
+                            del self._pending[key]
+                        return batch
+                    remaining = deadline - now
+                    timeout = remaining if timeout is None else min(timeout, remaining)
+                self._cv.wait(timeout=timeout)
+
+    def _loop(self):
+        while True:
+            batch = [(spec, future) for spec, future, _ in self._next_batch()]
+            try:
+                self._run_fn(batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+class _StageStats:
+    """
+    Thread safe latency bookkeeping for one stage of the generation pipeline.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._count = 0
+        self._items = 0
+        self._total = 0.0
+        self._last = 0.0
+
+    def record(self, seconds: float, items: int = 1):
+        with self._lock:
+            self._count += 1
+            self._items += items
+            self._total += seconds
+            self._last = seconds
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "calls": self._count,
+                "items": self._items,
+                "last_latency": self._last,
+                "avg_latency": self._total / self._count if self._count else 0.0,
+            }
+
+
+class _ResultCache:
+    """
+    A content addressed cache for encoded images.
+
+    Entries are kept in an in-memory LRU bounded by ``max_memory_bytes``. If
+    ``folder`` is given, entries are also written to disk (one file per key) and
+    the folder is bounded by ``max_disk_bytes``, evicting the least recently
+    used files first. This allows replicas that mount the same storage to share
+    results: a memory miss always looks for the file, whichever replica wrote it,
+    and the index of the folder is rebuilt from its content at least every
+    ``SCAN_INTERVAL`` seconds, so the bound applies to the files of all replicas.
+    """
+
+    SCAN_INTERVAL = 60
+
+    def __init__(
+        self,
+        max_memory_bytes: int,
+        folder: Optional[str] = None,
+        max_disk_bytes: int = 0,
+    ):
+        self._lock = Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._max_memory_bytes = max_memory_bytes
+        self._folder = folder
+        self._max_disk_bytes = max_disk_bytes
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._scanned_at = 0.0
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+            self._scan()
+
+    def _scan(self):
+        """
+        Rebuilds the index of the folder, least recently used first, including
+        the entries written by other replicas.
+        """
+        entries = []
+        for entry in os.scandir(self._folder):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Evicted by another replica in the meantime.
+                continue
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        disk = OrderedDict((name, size) for _, name, size in sorted(entries))
+        with self._lock:
+            self._disk = disk
+            self._disk_bytes = sum(disk.values())
+            self._scanned_at = time.time()
+
+    @staticmethod
+    def key(spec: dict) -> str:
+        return hashlib.sha256(
+            json.dumps(spec, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return self._memory[key]
+        if self._folder:
+            # The file is looked up even if it is not in the index, as another
+            # replica sharing the folder may have written it since the last scan.
+            path = os.path.join(self._folder, key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                with self._lock:
+                    self._disk_bytes -= self._disk.pop(key, 0)
+            else:
+                with self._lock:
+                    self._disk_bytes += len(data) - self._disk.pop(key, 0)
+                    self._disk[key] = len(data)
+                    self._counters["disk_hits"] += 1
+                self._put_memory(key, data)
+                return data
+        with self._lock:
+            self._counters["misses"] += 1
+        return None
+
+    def put(self, key: str, data: bytes):
+        self._put_memory(key, data)
+        if not self._folder or len(data) > self._max_disk_bytes:
+            return
+        path = os.path.join(self._folder, key)
+        # Write to a temp file first so readers never see partial files. The name
+        # is unique, as other replicas may write the same entry at the same time.
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Cannot write result cache entry {path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        if time.time() - self._scanned_at > self.SCAN_INTERVAL:
+            self._scan()
+        evicted = []
+        with self._lock:
+            self._disk_bytes += len(data) - self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            while self._disk_bytes > self._max_disk_bytes:
+                name, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(name)
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self._folder, name))
+            except OSError:
+                pass
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self._max_memory_bytes:
+            return
+        with self._lock:
+            self._memory_bytes += len(data) - len(self._memory.pop(key, b""))
+            self._memory[key] = data
+            while self._memory_bytes > self._max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._counters,
+                memory_entries=len(self._memory),
+                memory_bytes=self._memory_bytes,
+                disk_entries=len(self._disk),
+                disk_bytes=self._disk_bytes,
+            )
+
+
+class _AdmissionRejected(Exception):
+    def __init__(self, projected_wait: float):
+        super().__init__(f"projected queue wait {projected_wait:.1f}s")
+        self.projected_wait = projected_wait
+
+
+class _AdmissionController:
+    """
+    Admits requests into the generation pipeline based on their estimated cost.
+
+    At most ``max_inflight_cost`` worth of requests are in flight at any time,
+    the rest wait in FIFO order. A request that is more expensive than the whole
+    budget is admitted alone. Throughput (cost per second) is estimated from
+    completed requests, which gives a projected queue wait for new requests: a
+    request whose projected wait exceeds its deadline is rejected right away
+    instead of piling onto the queue, and a request still waiting when its
+    deadline passes is rejected as well. The controller knows nothing about the
+    actual pipeline, so it can be exercised with a stand-in that sleeps in
+    proportion to the cost.
+    """
+
+    def __init__(self, max_inflight_cost: float, smoothing: float = 0.2):
+        self._cv = Condition()
+        self._max_inflight_cost = max_inflight_cost
+        self._smoothing = smoothing
+        self._inflight_cost = 0.0
+        self._queue = deque()
+        self._queued_cost = 0.0
+        # Throughput is estimated as the completed cost over the time during
+        # which anything was in flight, exponentially decayed so that it follows
+        # recent load. None until the first request completes.
+        self._throughput = None
+        self._done_cost = 0.0
+        self._busy_time = 0.0
+        self._busy_mark = 0.0
+        self._counters = {"admitted": 0, "rejected": 0}
+        self._queue_time = _StageStats()
+        self._compute_time = _StageStats()
+
+    def _projected_wait(self, cost: float) -> Optional[float]:
+        if self._throughput is None:
+            return None
+        backlog = self._inflight_cost + self._queued_cost + cost
+        return max(0.0, backlog - self._max_inflight_cost) / self._throughput
+
+    def acquire(self, cost: float, deadline: Optional[float] = None) -> float:
+        """
+        Blocks until the request is admitted and returns the time it waited.
+        Raises _AdmissionRejected if it cannot start within ``deadline`` seconds.
+        """
+        start = time.time()
+        ticket = object()
+        with self._cv:
+            projected_wait = self._projected_wait(cost)
+            if deadline is not None and (projected_wait or 0.0) > deadline:
+                self._counters["rejected"] += 1
+                raise _AdmissionRejected(projected_wait)
+            self._queue.append(ticket)
+            self._queued_cost += cost
+            try:
+                while self._queue[0] is not ticket or (
+                    self._inflight_cost > 0
+                    and self._inflight_cost + cost > self._max_inflight_cost
+                ):
+                    timeout = None
+                    if deadline is not None:
+                        timeout = start + deadline - time.time()
+                        if timeout <= 0:
+                            self._counters["rejected"] += 1
+                            raise _AdmissionRejected(self._projected_wait(0) or 0.0)
+                    self._cv.wait(timeout=timeout)
+            except BaseException:
+                self._queue.remove(ticket)
+                self._queued_cost -= cost
+                self._cv.notify_all()
+                raise
+            self._queue.popleft()
+            self._queued_cost -= cost
+            if self._inflight_cost == 0:
+                self._busy_mark = time.time()
+            self._inflight_cost += cost
+            self._counters["admitted"] += 1
+            self._cv.notify_all()
+        waited = time.time() - start
+        self._queue_time.record(waited)
+        return waited
+
+    def release(self, cost: float, compute_start: float) -> float:
+        """
+        Marks an admitted request as finished and returns its compute time.
+        """
+        now = time.time()
+        with self._cv:
+            self._inflight_cost -= cost
+            self._busy_time += now - self._busy_mark
+            self._busy_mark = now
+            self._done_cost += cost
+            if self._busy_time > 0:
+                self._throughput = self._done_cost / self._busy_time
+                self._done_cost *= 1 - self._smoothing
+                self._busy_time *= 1 - self._smoothing
+            self._cv.notify_all()
+        self._compute_time.record(now - compute_start)
+        return now - compute_start
+
+    def stats(self):
+        with self._cv:
+            stats = dict(
+                self._counters,
+                inflight_cost=self._inflight_cost,
+                max_inflight_cost=self._max_inflight_cost,
+                queued_requests=len(self._queue),
+                queued_cost=self._queued_cost,
+                throughput=self._throughput,
+            )
+        stats["queue_time"] = self._queue_time.to_dict()
+        stats["compute_time"] = self._compute_time.to_dict()
+        return stats
+
+
+class _FakePipeline:
+    """
+    A stand-in for the SDXL base and refiner pipelines, so that the scheduling
+    around them (micro batching, the refiner stage, admission control) can be
+    exercised on CPU without the models. Set FAKE_PIPELINE=true to use it.
+
+    It takes the same arguments as the diffusers pipelines, and sleeps for
+    ``seconds_per_cost`` per unit of cost (megapixels x denoising steps, see
+    SDXL._cost) of one image, whatever the batch size, like a GPU does for small
+    batches. Each output image is filled with a color that only depends on its
+    prompt and generator, so one can tell whether it went back to the right
+    request.
+    """
+
+    # The refiner shares these with the base.
+    text_encoder_2 = None
+    vae = None
+
+    def __init__(self, seconds_per_cost: float):
+        self.seconds_per_cost = seconds_per_cost
+
+    def to(self, device):
+        return self
+
+    def encode_prompt(self, prompt, negative_prompt=None, **kwargs):
+        # A 24 bit hash of the prompt, which a float32 holds exactly.
+        code = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:6], 16)
+        zero = torch.zeros(1, 1)
+        return torch.full((1, 1), float(code)), zero, zero, zero
+
+    def __call__(
+        self,
+        prompt_embeds,
+        generator=None,
+        num_inference_steps=50,
+        width=None,
+        height=None,
+        output_type="pil",
+        denoising_end=None,
+        denoising_start=None,
+        image=None,
+        callback=None,
+        callback_steps=1,
+        **kwargs,
+    ):
+        if image is not None:
+            # The refiner continues from the latents of the base.
+            latents = image.clone()
+            height, width = latents.shape[2] * 8, latents.shape[3] * 8
+        else:
+            width, height = width or 1024, height or 1024
+            if not isinstance(generator, list):
+                generator = [generator] * len(prompt_embeds)
+            latents = torch.zeros(len(prompt_embeds), 4, height // 8, width // 8)
+            for i, g in enumerate(generator):
+                latents[i, 0] = prompt_embeds[i, 0] / 2**24
+                latents[i, 1] = torch.rand(1, generator=g).item()
+        steps = num_inference_steps * (
+            (denoising_end or 1.0) - (denoising_start or 0.0)
+        )
+        steps = max(1, round(steps))
+        for i in range(steps):
+            time.sleep(self.seconds_per_cost * width * height / 1e6)
+            if callback is not None and i % callback_steps == 0:
+                callback(i, i, latents)
+        if output_type == "latent":
+            return SimpleNamespace(images=latents)
+        return SimpleNamespace(
+            images=[
+                Image.new(
+                    "RGB",
+                    (width, height),
+                    (int(item[0, 0, 0] * 255), int(item[1, 0, 0] * 255), 0),
+                )
+                for item in latents
+            ]
+        )
 
 
 class SDXL(Photon):
@@ -16,6 +472,47 @@ class SDXL(Photon):
         "invisible-watermark",
     ]
 
+    # Concurrent requests are coalesced by the micro batcher, so the handler needs
+    # to accept more requests than a single batch holds.
+    handler_max_concurrency = 16
+
+    # Defaults of the generation parameters shared by the run* handlers.
+    DEFAULT_SPEC = dict(
+        negative_prompt=None,
+        width=None,
+        height=None,
+        guidance_scale=5.0,
+        seed=None,
+        num_inference_steps=50,
+        high_noise_frac=0.8,
+        use_refiner=True,
+    )
+    # Maximum number of images a single run_batch request can ask for.
+    MAX_BATCH_IMAGES = 16
+    # Upper bounds of the generation parameters, see _check_spec.
+    MAX_IMAGE_SIZE = 2048
+    MAX_INFERENCE_STEPS = 200
+    # Supported output formats, mapping to (PIL format, media type).
+    OUTPUT_FORMATS = {
+        "png": ("PNG", "image/png"),
+        "jpeg": ("JPEG", "image/jpeg"),
+        "webp": ("WEBP", "image/webp"),
+    }
+
+    BASE_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+    REFINER_MODEL = "stabilityai/stable-diffusion-xl-refiner-1.0"
+
+    # Linear approximation of the SDXL VAE decoder, mapping the 4 latent channels
+    # to RGB. It is orders of magnitude cheaper than the actual VAE and good
+    # enough for 1/8 resolution previews.
+    PREVIEW_LATENT_RGB_FACTORS = [
+        [0.3920, 0.4054, 0.4549],
+        [-0.2634, -0.0196, 0.0653],
+        [0.0568, 0.1687, -0.0755],
+        [-0.3112, -0.2359, -0.2076],
+    ]
+    PREVIEW_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
     def init(self):
         cuda_available = torch.cuda.is_available()
 
@@ -24,15 +521,17 @@ class SDXL(Photon):
         else:
             self.device = torch.device("cpu")
 
+        # Startup timeline, one entry per (component, phase), so one can see where
+        # cold start time goes.
+        self._init_start = time.time()
+        self._timeline = []
+        self._timeline_lock = Lock()
+
         # load both base & refiner
-        self.base = DiffusionPipeline.from_pretrained(
-            "stabilityai/stable-diffusion-xl-base-1.0",
-            torch_dtype=torch.float16,
-            variant="fp16",
-            use_safetensors=True,
-        )
+        self.base = self._load_pipeline("base", self.BASE_MODEL)
         if cuda_available:
-            self.base.to("cuda")
+            with self._timed("base", "device_transfer"):
+                self.base.to("cuda")
             # torch.compile is affected by the following issue. If you encounter problems,
             # comment the torch.compile line.
             # https://github.com/huggingface/diffusers/issues/4370
@@ -41,28 +540,150 @@ class SDXL(Photon):
             # )
 
         self._refiner = None
+        self._refiner_load_lock = Lock()
+        self._refiner_ready = Event()
+
+        # A diffusers pipeline keeps per-call state (e.g. the scheduler timesteps),
+        # so each pipeline must only run one call at a time.
+        self._base_lock = Lock()
+        self._refiner_lock = Lock()
+        self._base_stats = _StageStats()
+        self._refiner_stats = _StageStats()
+
+        # Batches that went through the base denoiser are handed over to the
+        # refiner worker through a bounded queue, so that the base pass of batch
+        # N+1 overlaps the refiner pass of batch N. The bound limits how many
+        # latents can pile up in GPU memory if the refiner falls behind.
+        self._refiner_queue = Queue(
+            maxsize=int(os.environ.get("REFINER_QUEUE_SIZE", 2))
+        )
+        Thread(target=self._refiner_worker, daemon=True).start()
+
+        # Text encoder outputs per unique (pipeline, prompt, negative_prompt).
+        self._prompt_cache = OrderedDict()
+        self._prompt_cache_size = int(os.environ.get("PROMPT_CACHE_SIZE", 128))
+        self._prompt_cache_lock = Lock()
+        self._prompt_cache_counters = {"hits": 0, "misses": 0}
+
+        # Seeded generations are deterministic, so their encoded results are cached.
+        # Set RESULT_CACHE_FOLDER (e.g. on a mounted Lepton storage) to also keep
+        # results on disk and share them across replicas.
+        self._result_cache = _ResultCache(
+            max_memory_bytes=int(os.environ.get("RESULT_CACHE_MB", 256)) * 2**20,
+            folder=os.environ.get("RESULT_CACHE_FOLDER"),
+            max_disk_bytes=int(os.environ.get("RESULT_CACHE_DISK_MB", 4096)) * 2**20,
+        )
+
+        # Admission control in front of the pipeline. The cost of a request is
+        # estimated as megapixels x denoising steps, so a default 1024x1024, 50
+        # step image costs ~52. ADMISSION_MAX_COST bounds the total cost in flight,
+        # and should leave room for a full batch in each of the two stages.
+        self._admission = _AdmissionController(
+            max_inflight_cost=float(os.environ.get("ADMISSION_MAX_COST", 420))
+        )
+
+        # Requests to "run" that arrive within BATCH_WINDOW_MS of each other and
+        # share the same shape are denoised together in one pipeline call. Set
+        # MAX_BATCH_SIZE=1 to disable batching.
+        self._batcher = _MicroBatcher(
+            run_fn=self._run_batch,
+            key_fn=self._batch_key,
+            max_batch_size=int(os.environ.get("MAX_BATCH_SIZE", 4)),
+            window=float(os.environ.get("BATCH_WINDOW_MS", 50)) / 1000,
+        )
+
+        # PNG encoding releases the GIL in zlib, so multiple images of one request
+        # can be encoded in parallel.
+        self._encode_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("ENCODE_WORKERS", 4))
+        )
+
+        with self._timeline_lock:
+            self._timeline.append({
+                "component": "base",
+                "phase": "ready",
+                "at": time.time() - self._init_start,
+            })
+
+        # Loading the refiner takes a while, so instead of paying for it in the
+        # first request that needs it, we warm it up in the background once the
+        # base is ready. Set PRELOAD_REFINER=false to keep it fully lazy.
+        if os.environ.get("PRELOAD_REFINER", "true").lower() in ("1", "true", "yes"):
+            Thread(target=self._warm_refiner, daemon=True).start()
+
+    @contextmanager
+    def _timed(self, component, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self._timeline_lock:
+                self._timeline.append({
+                    "component": component,
+                    "phase": phase,
+                    "seconds": end - start,
+                    "at": end - self._init_start,
+                })
+            logger.info(f"{component} {phase} took {end - start:.2f}s")
+
+    def _load_pipeline(self, component, model_id, **kwargs):
+        if os.environ.get("FAKE_PIPELINE", "false").lower() in ("1", "true", "yes"):
+            return _FakePipeline(float(os.environ.get("FAKE_SECONDS_PER_COST", 0.002)))
+        kwargs.update(torch_dtype=torch.float16, variant="fp16", use_safetensors=True)
+        # Downloading separately from from_pretrained makes the download and the
+        # deserialization show up as separate phases in the timeline. It is a
+        # no-op when the files are already in the local cache.
+        with self._timed(component, "download"):
+            path = DiffusionPipeline.download(model_id, **kwargs)
+        with self._timed(component, "deserialize"):
+            return DiffusionPipeline.from_pretrained(path, **kwargs)
+
+    def _warm_refiner(self):
+        try:
+            self.refiner
+        except Exception as e:
+            logger.error(f"Failed to warm load the refiner: {e}")
 
     @property
     def refiner(self):
         if self._refiner is None:
-            pipe = DiffusionPipeline.from_pretrained(
-                "stabilityai/stable-diffusion-xl-refiner-1.0",
-                text_encoder_2=self.base.text_encoder_2,
-                vae=self.base.vae,
-                torch_dtype=torch.float16,
-                use_safetensors=True,
-                variant="fp16",
-            )
-            if torch.cuda.is_available():
+            # If the background warm load is in progress, this waits for it
+            # instead of loading a second copy.
+            with self._refiner_load_lock:
+                if self._refiner is None:
+                    self._refiner = self._load_refiner()
+                    self._refiner_ready.set()
+        return self._refiner
+
+    def _load_refiner(self):
+        pipe = self._load_pipeline(
+            "refiner",
+            self.REFINER_MODEL,
+            text_encoder_2=self.base.text_encoder_2,
+            vae=self.base.vae,
+        )
+        if torch.cuda.is_available():
+            with self._timed("refiner", "device_transfer"):
                 pipe.to("cuda")
 
-                # torch.compile is affected by the following issue. If you encounter problems,
-                # comment the torch.compile line.
-                # pipe.unet = torch.compile(
-                #    pipe.unet, mode="reduce-overhead", fullgraph=True
-                # )
-            self._refiner = pipe
-        return self._refiner
+            # torch.compile is affected by the following issue. If you encounter problems,
+            # comment the torch.compile line.
+            # pipe.unet = torch.compile(
+            #    pipe.unet, mode="reduce-overhead", fullgraph=True
+            # )
+        return pipe
+
+    @Photon.handler("startup_timeline")
+    def startup_timeline(self) -> dict:
+        """
+        Returns how long each startup phase (download, deserialize, device
+        transfer) took per component, and whether the refiner is loaded yet.
+        ``at`` is the time since init started at which the phase finished.
+        """
+        with self._timeline_lock:
+            timeline = list(self._timeline)
+        return {"refiner_ready": self._refiner_ready.is_set(), "timeline": timeline}
 
     @Photon.handler(
         "run",
@@ -83,24 +704,466 @@ class SDXL(Photon):
         num_inference_steps: Optional[int] = 50,
         high_noise_frac: Optional[float] = 0.8,
         use_refiner: Optional[bool] = True,
-    ) -> PNGResponse:
-        images = self._run(
+        output_format: str = "png",
+        quality: int = 90,
+        compress_level: int = 6,
+        deadline: Optional[float] = None,
+    ) -> Response:
+        """
+        Generates an image. ``output_format`` is one of "png", "jpeg" or "webp".
+        ``quality`` (1-100) applies to jpeg and webp, ``compress_level`` (0-9)
+        applies to png, where lower levels encode faster but produce larger
+        files.
+
+        If ``deadline`` is given, the request is rejected with a 503 when it is
+        not expected to start generating within that many seconds. The time
+        spent waiting for admission and generating is reported in the
+        X-Queue-Time and X-Compute-Time response headers.
+        """
+        encoding = self._encoding(output_format, quality, compress_level)
+        spec = dict(
             prompt=prompt,
             negative_prompt=negative_prompt,
             width=width,
             height=height,
             guidance_scale=guidance_scale,
-            samples=1,
             seed=seed,
             num_inference_steps=num_inference_steps,
             high_noise_frac=high_noise_frac,
             use_refiner=use_refiner,
         )
+        self._check_spec(spec)
+        media_type = self.OUTPUT_FORMATS[output_format][1]
+        # Unseeded requests are random by definition and bypass the cache.
+        cache_key = self._result_cache_key(spec, encoding)
+        if cache_key is not None:
+            data = self._result_cache.get(cache_key)
+            if data is not None:
+                return Response(content=data, media_type=media_type)
+
+        cost, queue_time = self._admit([spec], deadline)
+        compute_start = time.time()
+        try:
+            image = self._batcher.submit(spec).result()
+        finally:
+            compute_time = self._admission.release(cost, compute_start)
+
+        data = self._encode(image, encoding)
+        if cache_key is not None:
+            self._result_cache.put(cache_key, data)
+        # The encoded bytes are the response body as they are, see _encode.
+        return Response(
+            content=data,
+            media_type=media_type,
+            headers=self._timing_headers(queue_time, compute_time),
+        )
+
+    @Photon.handler(
+        "run_batch",
+        example={
+            "prompt": "A majestic lion jumping from a big stone at night",
+            "samples": 4,
+            "seed": 1234,
+        },
+    )
+    def run_batch(
+        self,
+        specs: Optional[List[Dict[str, Any]]] = None,
+        prompt: Optional[str] = None,
+        samples: int = 1,
+        negative_prompt: Optional[str] = None,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        guidance_scale: Optional[float] = 5.0,
+        seed: Optional[int] = None,
+        num_inference_steps: Optional[int] = 50,
+        high_noise_frac: Optional[float] = 0.8,
+        use_refiner: Optional[bool] = True,
+        output_format: str = "png",
+        quality: int = 90,
+        compress_level: int = 6,
+        deadline: Optional[float] = None,
+    ) -> Response:
+        """
+        Generates multiple images in one request and returns them as a zip file
+        with entries ``0.png``, ``1.png``, ... in request order (the extension
+        follows ``output_format``, see "run" for the encoding arguments).
+
+        Either pass ``specs``, a list of dicts with the same keys as the "run"
+        arguments (missing keys take the "run" defaults), or ``prompt`` together
+        with ``samples`` and the other "run" arguments. In the latter case, if a
+        seed is given, the i-th sample uses ``seed + i``. A spec with arguments of
+        the wrong type or out of range fails the request with a 400.
+
+        All images are submitted to the micro batcher at once, so compatible
+        specs are denoised together, and are encoded in parallel. The request is
+        admitted as a whole, see "run" for ``deadline``.
+        """
+        encoding = self._encoding(output_format, quality, compress_level)
+        if specs is None:
+            if prompt is None:
+                raise HTTPException(400, "Either specs or prompt must be provided.")
+            specs = [
+                dict(
+                    prompt=prompt,
+                    negative_prompt=negative_prompt,
+                    width=width,
+                    height=height,
+                    guidance_scale=guidance_scale,
+                    seed=None if seed is None else seed + i,
+                    num_inference_steps=num_inference_steps,
+                    high_noise_frac=high_noise_frac,
+                    use_refiner=use_refiner,
+                )
+                for i in range(samples)
+            ]
+        if not 0 < len(specs) <= self.MAX_BATCH_IMAGES:
+            raise HTTPException(
+                400,
+                f"Number of images must be in [1, {self.MAX_BATCH_IMAGES}], got"
+                f" {len(specs)}.",
+            )
+        for i, spec in enumerate(specs):
+            unknown = set(spec) - set(self.DEFAULT_SPEC) - {"prompt"}
+            if "prompt" not in spec or unknown:
+                raise HTTPException(
+                    400,
+                    f"Spec {i} must contain a prompt and only the arguments of run,"
+                    f" got {sorted(spec)}.",
+                )
+            specs[i] = dict(self.DEFAULT_SPEC, **spec)
+            self._check_spec(specs[i], f"specs[{i}].")
+
+        def encode(image, cache_key):
+            data = self._encode(image, encoding)
+            if cache_key is not None:
+                self._result_cache.put(cache_key, data)
+            return data
+
+        results = [None] * len(specs)
+        misses = []
+        for i, spec in enumerate(specs):
+            cache_key = self._result_cache_key(spec, encoding)
+            if cache_key is not None:
+                results[i] = self._result_cache.get(cache_key)
+            if results[i] is None:
+                misses.append((i, cache_key))
+
+        queue_time, compute_time = 0.0, 0.0
+        if misses:
+            cost, queue_time = self._admit([specs[i] for i, _ in misses], deadline)
+            compute_start = time.time()
+            try:
+                pending = {self._batcher.submit(specs[i]): (i, k) for i, k in misses}
+                # Images are encoded as soon as their batch finishes, overlapping
+                # with the generation of the remaining ones.
+                for future in as_completed(pending):
+                    i, cache_key = pending[future]
+                    results[i] = self._encode_pool.submit(
+                        encode, future.result(), cache_key
+                    )
+            finally:
+                compute_time = self._admission.release(cost, compute_start)
+
+        zip_io = BytesIO()
+        # Image data is already compressed, so the entries are simply stored.
+        with zipfile.ZipFile(zip_io, "w", compression=zipfile.ZIP_STORED) as zf:
+            for i, data in enumerate(results):
+                if not isinstance(data, bytes):
+                    data = data.result()
+                zf.writestr(f"{i}.{output_format}", data)
+        return Response(
+            content=zip_io.getvalue(),
+            media_type="application/zip",
+            headers=self._timing_headers(queue_time, compute_time),
+        )
+
+    def _check_spec(self, spec: dict, name: str = ""):
+        """
+        Raises a 400 if an argument of a generation spec has the wrong type or is
+        out of range. Specs are batched with those of other requests, so they
+        must be checked before they reach the micro batcher: an invalid one would
+        fail the whole batch.
+        """
+
+        def is_int(value):
+            return isinstance(value, int) and not isinstance(value, bool)
+
+        def is_number(value):
+            return (is_int(value) or isinstance(value, float)) and math.isfinite(value)
+
+        checks = [
+            ("prompt", "a string", isinstance(spec["prompt"], str)),
+            (
+                "negative_prompt",
+                "a string or null",
+                spec["negative_prompt"] is None
+                or isinstance(spec["negative_prompt"], str),
+            ),
+            (
+                "guidance_scale",
+                "a number >= 0",
+                is_number(spec["guidance_scale"]) and spec["guidance_scale"] >= 0,
+            ),
+            (
+                "seed",
+                "null or an integer in [0, 2**64)",
+                spec["seed"] is None
+                or (is_int(spec["seed"]) and 0 <= spec["seed"] < 2**64),
+            ),
+            (
+                "num_inference_steps",
+                f"an integer in [1, {self.MAX_INFERENCE_STEPS}]",
+                is_int(spec["num_inference_steps"])
+                and 1 <= spec["num_inference_steps"] <= self.MAX_INFERENCE_STEPS,
+            ),
+            (
+                "high_noise_frac",
+                "a number in [0, 1]",
+                is_number(spec["high_noise_frac"])
+                and 0 <= spec["high_noise_frac"] <= 1,
+            ),
+            ("use_refiner", "a boolean", isinstance(spec["use_refiner"], bool)),
+        ]
+        for key in ("width", "height"):
+            value = spec[key]
+            checks.append((
+                key,
+                f"null or a multiple of 8 in [64, {self.MAX_IMAGE_SIZE}]",
+                value is None
+                or (
+                    is_int(value)
+                    and 64 <= value <= self.MAX_IMAGE_SIZE
+                    and value % 8 == 0
+                ),
+            ))
+        for key, expected, ok in checks:
+            if not ok:
+                raise HTTPException(
+                    400, f"{name}{key} must be {expected}, got {spec[key]!r}."
+                )
 
+    @staticmethod
+    def _cost(spec) -> float:
+        width = spec["width"] or 1024
+        height = spec["height"] or 1024
+        return width * height * spec["num_inference_steps"] / 1e6
+
+    def _admit(self, specs, deadline):
+        """
+        Waits for admission of the given specs, returning (cost, queue time), or
+        raises a 503 if they cannot start within ``deadline`` seconds.
+        """
+        cost = sum(self._cost(spec) for spec in specs)
+        try:
+            return cost, self._admission.acquire(cost, deadline)
+        except _AdmissionRejected as e:
+            raise HTTPException(
+                503,
+                detail=(
+                    f"Server is busy: the projected queue wait {e.projected_wait:.1f}s"
+                    f" exceeds the deadline {deadline}s."
+                ),
+                headers={"Retry-After": str(max(1, math.ceil(e.projected_wait)))},
+            )
+
+    @staticmethod
+    def _timing_headers(queue_time, compute_time):
+        return {
+            "X-Queue-Time": f"{queue_time:.3f}",
+            "X-Compute-Time": f"{compute_time:.3f}",
+        }
+
+    def _result_cache_key(self, spec, encoding) -> Optional[str]:
+        if spec["seed"] is None:
+            return None
+        return _ResultCache.key(
+            dict(
+                spec,
+                encoding=encoding,
+                base_model=self.BASE_MODEL,
+                refiner_model=self.REFINER_MODEL,
+            )
+        )
+
+    def _encoding(self, output_format, quality, compress_level):
+        if output_format not in self.OUTPUT_FORMATS:
+            raise HTTPException(
+                400,
+                f"Unsupported output format: {output_format}. Supported formats:"
+                f" {list(self.OUTPUT_FORMATS)}",
+            )
+        if not 1 <= quality <= 100:
+            raise HTTPException(400, f"quality must be in [1, 100], got {quality}")
+        if not 0 <= compress_level <= 9:
+            raise HTTPException(
+                400, f"compress_level must be in [0, 9], got {compress_level}"
+            )
+        if output_format == "png":
+            return dict(format="PNG", compress_level=compress_level)
+        return dict(format=self.OUTPUT_FORMATS[output_format][0], quality=quality)
+
+    @staticmethod
+    def _encode(image, encoding) -> bytes:
         img_io = BytesIO()
-        images[0].save(img_io, format="PNG", quality="keep")
-        img_io.seek(0)
-        return PNGResponse(img_io)
+        image.save(img_io, **encoding)
+        # getvalue() trims the buffer the image was encoded into and returns it,
+        # rather than a copy, as long as no view of it from getbuffer() is alive.
+        # Response needs bytes, so a memoryview would be copied there instead.
+        return img_io.getvalue()
+
+    @Photon.handler(
+        "run_stream",
+        example={
+            "prompt": "A majestic lion jumping from a big stone at night",
+            "num_inference_steps": 40,
+            "preview_steps": 5,
+        },
+    )
+    def run_stream(
+        self,
+        prompt: str,
+        negative_prompt: Optional[str] = None,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        guidance_scale: Optional[float] = 5.0,
+        seed: Optional[int] = None,
+        num_inference_steps: Optional[int] = 50,
+        high_noise_frac: Optional[float] = 0.8,
+        use_refiner: Optional[bool] = True,
+        preview_steps: int = 5,
+        deadline: Optional[float] = None,
+    ) -> StreamingResponse:
+        """
+        Same as "run", but streams a low resolution JPEG preview every
+        ``preview_steps`` denoising steps (0 for none), followed by the final
+        PNG, as a ``multipart/x-mixed-replace`` response. Browsers render such a
+        response in an <img> tag directly, replacing each frame with the next one.
+
+        The status code is sent before generation starts, so a failure is
+        reported in the stream itself: instead of the final PNG, the last part is
+        an ``application/json`` object with an "error" key. Either way, the
+        stream ends with the closing boundary.
+
+        Previews are decoded with a linear approximation of the VAE at latent
+        resolution, and JPEG encoding happens on the streaming thread, so the
+        denoising loop itself only pays for a tiny matmul every few steps.
+
+        See "run" for ``deadline``. Only the queue time is reported in the
+        headers, as they are sent before generation starts.
+        """
+        spec = dict(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            width=width,
+            height=height,
+            guidance_scale=guidance_scale,
+            seed=seed,
+            num_inference_steps=num_inference_steps,
+            high_noise_frac=high_noise_frac,
+            use_refiner=use_refiner,
+        )
+        # Checked before the status code is sent, so that bad arguments get a 400
+        # instead of an error part in the stream.
+        self._check_spec(spec)
+        if (
+            not isinstance(preview_steps, int)
+            or isinstance(preview_steps, bool)
+            or preview_steps < 0
+        ):
+            raise HTTPException(
+                400, f"preview_steps must be an integer >= 0, got {preview_steps!r}."
+            )
+        cost, queue_time = self._admit([spec], deadline)
+        compute_start = time.time()
+        frames = Queue()
+        step = 0
+
+        def callback(i, t, latents):
+            nonlocal step
+            step += 1
+            if preview_steps > 0 and step % preview_steps == 0:
+                frames.put(("image/jpeg", self._preview(latents)))
+
+        def generate():
+            try:
+                generator = None
+                if seed is not None:
+                    generator = torch.Generator(device=self.device).manual_seed(seed)
+                kwargs = dict(
+                    prompt=prompt,
+                    negative_prompt=negative_prompt,
+                    guidance_scale=guidance_scale,
+                    generator=generator,
+                    num_inference_steps=num_inference_steps,
+                    high_noise_frac=high_noise_frac,
+                    callback=callback,
+                )
+                images = self._base_pass(
+                    width=width, height=height, use_refiner=use_refiner, **kwargs
+                )
+                if use_refiner:
+                    images = self._refiner_pass(latents=images, **kwargs)
+                frames.put(("image/png", images[0]))
+            except Exception as e:
+                logger.error(f"Error in streamed generation: {e}")
+                frames.put(("application/json", {"error": str(e)}))
+            finally:
+                self._admission.release(cost, compute_start)
+                frames.put(None)
+
+        Thread(target=generate, daemon=True).start()
+
+        def stream():
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    yield b"--frame--\r\n"
+                    return
+                content_type, content = frame
+                if content_type == "application/json":
+                    data = json.dumps(content).encode("utf-8")
+                else:
+                    img_io = BytesIO()
+                    if content_type == "image/jpeg":
+                        content.save(img_io, format="JPEG", quality=70)
+                    else:
+                        content.save(img_io, format="PNG")
+                    data = img_io.getvalue()
+                yield (
+                    (
+                        f"--frame\r\nContent-Type: {content_type}\r\n"
+                        f"Content-Length: {len(data)}\r\n\r\n"
+                    ).encode("ascii")
+                    + data
+                    + b"\r\n"
+                )
+
+        return StreamingResponse(
+            stream(),
+            media_type="multipart/x-mixed-replace; boundary=frame",
+            headers={"X-Queue-Time": f"{queue_time:.3f}"},
+        )
+
+    def _preview(self, latents):
+        """
+        Approximately decodes the first latent of a batch into a PIL image at
+        latent resolution (1/8 of the output size).
+        """
+        with torch.no_grad():
+            factors = torch.tensor(
+                self.PREVIEW_LATENT_RGB_FACTORS,
+                dtype=latents.dtype,
+                device=latents.device,
+            )
+            bias = torch.tensor(
+                self.PREVIEW_LATENT_RGB_BIAS,
+                dtype=latents.dtype,
+                device=latents.device,
+            )
+            rgb = torch.einsum("chw,cr->hwr", latents[0], factors) + bias
+            rgb = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+        return Image.fromarray(rgb)
 
     def _run(
         self,
@@ -114,6 +1177,40 @@ class SDXL(Photon):
         num_inference_steps,
         high_noise_frac,
         use_refiner,
+    ):
+        # The gradio UI goes through admission control like the handlers, only
+        # without a deadline.
+        spec = dict(width=width, height=height, num_inference_steps=num_inference_steps)
+        cost, _ = self._admit([spec] * samples, None)
+        compute_start = time.time()
+        try:
+            return self._generate(
+                prompt,
+                negative_prompt,
+                width,
+                height,
+                guidance_scale,
+                samples,
+                seed,
+                num_inference_steps,
+                high_noise_frac,
+                use_refiner,
+            )
+        finally:
+            self._admission.release(cost, compute_start)
+
+    def _generate(
+        self,
+        prompt,
+        negative_prompt,
+        width,
+        height,
+        guidance_scale,
+        samples,
+        seed,
+        num_inference_steps,
+        high_noise_frac,
+        use_refiner,
     ):
         if seed is not None:
             generator = torch.Generator(device=self.device).manual_seed(seed)
@@ -126,12 +1223,7 @@ class SDXL(Photon):
                 negative_prompt = [negative_prompt] * samples
             generator = [generator] * samples
 
-        base_extra_kwargs = {}
-        if use_refiner:
-            base_extra_kwargs["output_type"] = "latent"
-            base_extra_kwargs["denoising_end"] = high_noise_frac
-        # run both experts
-        images = self.base(
+        images = self._base_pass(
             prompt=prompt,
             negative_prompt=negative_prompt,
             width=width,
@@ -139,20 +1231,220 @@ class SDXL(Photon):
             guidance_scale=guidance_scale,
             generator=generator,
             num_inference_steps=num_inference_steps,
-            **base_extra_kwargs,
-        ).images
+            high_noise_frac=high_noise_frac,
+            use_refiner=use_refiner,
+        )
         if use_refiner:
-            images = self.refiner(
+            images = self._refiner_pass(
                 prompt=prompt,
                 negative_prompt=negative_prompt,
                 guidance_scale=guidance_scale,
+                generator=generator,
+                num_inference_steps=num_inference_steps,
+                high_noise_frac=high_noise_frac,
+                latents=images,
+            )
+        return images
+
+    @staticmethod
+    def _batch_key(spec):
+        # Everything that has to be identical across the items of one pipeline call.
+        return (
+            spec["width"],
+            spec["height"],
+            spec["guidance_scale"],
+            spec["num_inference_steps"],
+            spec["high_noise_frac"],
+            spec["use_refiner"],
+        )
+
+    def _run_batch(self, batch):
+        """
+        The base stage: runs a list of (spec, future) pairs that share the same
+        batch key as a single batch, with per-item prompts and per-item seeded
+        generators. Refined batches are handed over to the refiner worker, others
+        are resolved right away.
+        """
+        specs = [spec for spec, _ in batch]
+        generator = []
+        for spec in specs:
+            g = torch.Generator(device=self.device)
+            if spec["seed"] is not None:
+                g.manual_seed(spec["seed"])
+            else:
+                g.seed()
+            generator.append(g)
+
+        first = specs[0]
+        kwargs = dict(
+            prompt=[spec["prompt"] for spec in specs],
+            negative_prompt=[spec["negative_prompt"] for spec in specs],
+            guidance_scale=first["guidance_scale"],
+            generator=generator,
+            num_inference_steps=first["num_inference_steps"],
+            high_noise_frac=first["high_noise_frac"],
+        )
+        images = self._base_pass(
+            width=first["width"],
+            height=first["height"],
+            use_refiner=first["use_refiner"],
+            **kwargs,
+        )
+        if first["use_refiner"]:
+            # Blocks when the refiner is behind, which in turn holds back new
+            # batches in the micro batcher.
+            self._refiner_queue.put((batch, images, kwargs))
+        else:
+            for (_, future), image in zip(batch, images):
+                future.set_result(image)
+
+    def _refiner_worker(self):
+        while True:
+            batch, latents, kwargs = self._refiner_queue.get()
+            try:
+                images = self._refiner_pass(latents=latents, **kwargs)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), image in zip(batch, images):
+                    future.set_result(image)
+
+    def _base_pass(
+        self,
+        prompt,
+        negative_prompt,
+        width,
+        height,
+        guidance_scale,
+        generator,
+        num_inference_steps,
+        high_noise_frac,
+        use_refiner,
+        callback=None,
+    ):
+        base_extra_kwargs = {}
+        if use_refiner:
+            base_extra_kwargs["output_type"] = "latent"
+            base_extra_kwargs["denoising_end"] = high_noise_frac
+        if callback is not None:
+            base_extra_kwargs["callback"] = callback
+            base_extra_kwargs["callback_steps"] = 1
+        embeds = self._prompt_embeds("base", self.base, prompt, negative_prompt)
+        with self._base_lock:
+            start = time.time()
+            images = self.base(
+                **embeds,
+                width=width,
+                height=height,
+                guidance_scale=guidance_scale,
+                generator=generator,
+                num_inference_steps=num_inference_steps,
+                **base_extra_kwargs,
+            ).images
+            self._base_stats.record(time.time() - start, len(images))
+        return images
+
+    def _refiner_pass(
+        self,
+        prompt,
+        negative_prompt,
+        guidance_scale,
+        generator,
+        num_inference_steps,
+        high_noise_frac,
+        latents,
+        callback=None,
+    ):
+        refiner = self.refiner
+        embeds = self._prompt_embeds("refiner", refiner, prompt, negative_prompt)
+        refiner_extra_kwargs = {}
+        if callback is not None:
+            refiner_extra_kwargs["callback"] = callback
+            refiner_extra_kwargs["callback_steps"] = 1
+        with self._refiner_lock:
+            start = time.time()
+            images = refiner(
+                **embeds,
+                guidance_scale=guidance_scale,
                 num_inference_steps=num_inference_steps,
                 generator=generator,
                 denoising_start=high_noise_frac,
-                image=images,
+                image=latents,
+                **refiner_extra_kwargs,
             ).images
+            self._refiner_stats.record(time.time() - start, len(images))
         return images
 
+    def _prompt_embeds(self, name, pipe, prompt, negative_prompt):
+        """
+        Returns the embedding kwargs of ``pipe`` for the given (lists of) prompts.
+        Each unique (prompt, negative_prompt) pair is encoded once and kept in a
+        bounded LRU, so e.g. variations of one prompt with different seeds skip
+        the text encoders entirely. The base and the refiner condition on
+        different encoder outputs, so ``name`` keeps their entries apart.
+        """
+        if isinstance(prompt, str):
+            prompt = [prompt]
+        if negative_prompt is None or isinstance(negative_prompt, str):
+            negative_prompt = [negative_prompt] * len(prompt)
+
+        embeds = []
+        for p, n in zip(prompt, negative_prompt):
+            key = (name, p, n)
+            with self._prompt_cache_lock:
+                cached = self._prompt_cache.get(key)
+                if cached is not None:
+                    self._prompt_cache.move_to_end(key)
+                    self._prompt_cache_counters["hits"] += 1
+            if cached is None:
+                # Classifier free guidance embeddings are always computed, the
+                # pipeline simply ignores the negative ones when it is disabled.
+                with torch.no_grad():
+                    cached = pipe.encode_prompt(
+                        prompt=p,
+                        device=self.device,
+                        num_images_per_prompt=1,
+                        do_classifier_free_guidance=True,
+                        negative_prompt=n,
+                    )
+                with self._prompt_cache_lock:
+                    self._prompt_cache_counters["misses"] += 1
+                    self._prompt_cache[key] = cached
+                    while len(self._prompt_cache) > self._prompt_cache_size:
+                        self._prompt_cache.popitem(last=False)
+            embeds.append(cached)
+
+        names = (
+            "prompt_embeds",
+            "negative_prompt_embeds",
+            "pooled_prompt_embeds",
+            "negative_pooled_prompt_embeds",
+        )
+        return {
+            k: torch.cat([embed[i] for embed in embeds]) for i, k in enumerate(names)
+        }
+
+    @Photon.handler("pipeline_stats")
+    def pipeline_stats(self) -> dict:
+        """
+        Returns the queue depths and per-stage latencies of the batched generation
+        pipeline, which is useful to size MAX_BATCH_SIZE, REFINER_QUEUE_SIZE and
+        ADMISSION_MAX_COST, together with the result and prompt cache counters.
+        """
+        return {
+            "pending_requests": self._batcher.pending(),
+            "refiner_queue_depth": self._refiner_queue.qsize(),
+            "refiner_queue_size": self._refiner_queue.maxsize,
+            "base": self._base_stats.to_dict(),
+            "refiner": self._refiner_stats.to_dict(),
+            "admission": self._admission.stats(),
+            "result_cache": self._result_cache.stats(),
+            "prompt_cache": dict(
+                self._prompt_cache_counters, entries=len(self._prompt_cache)
+            ),
+        }
+
     @Photon.handler(mount=True)
     def ui(self):
         blocks = gr.Blocks()
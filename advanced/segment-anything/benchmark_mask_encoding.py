@@ -0,0 +1,78 @@
+"""
+Compares the encoding time and payload size of the mask formats supported by the
+SAM photon ("pickle", "rle" and "packbits") on synthetic masks that resemble the
+output of the automatic mask generator: many blobs of varying sizes on a large
+image. Run it next to sam.py with
+
+    python benchmark_mask_encoding.py
+
+Every format is measured on what the endpoints send, i.e. the JSON response
+body: for "pickle", the lepton_pickle payload (zlib at level 9 over the pickled
+masks, in base64), for the other formats the JSON list of encoded masks.
+"""
+
+import json
+import time
+
+import numpy as np
+
+from leptonai.photon.types import lepton_pickle, lepton_unpickle
+from sam import decode_masks, encode_packbits, encode_rle
+
+
+def synthetic_masks(height=1500, width=2000, count=100, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:height, :width]
+    masks = []
+    for _ in range(count):
+        cy, cx = rng.uniform(0, height), rng.uniform(0, width)
+        ry, rx = rng.uniform(10, height / 4), rng.uniform(10, width / 4)
+        segmentation = ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1
+        masks.append({"segmentation": segmentation, "area": int(segmentation.sum())})
+    return masks
+
+
+def pickle_encode(masks):
+    return json.dumps(lepton_pickle(masks, compression=9)).encode("utf-8")
+
+
+def json_encode(encode):
+    def fn(masks):
+        return json.dumps([
+            {"segmentation": encode(m["segmentation"]), "area": m["area"]}
+            for m in masks
+        ]).encode("utf-8")
+
+    return fn
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    masks = synthetic_masks()
+    h, w = masks[0]["segmentation"].shape
+    print(f"{len(masks)} masks of {w}x{h}")
+    print(f"{'format':<10} {'encode (ms)':>12} {'decode (ms)':>12} {'size (KB)':>10}")
+    for name, encode, decode in [
+        ("pickle", pickle_encode, lambda d: lepton_unpickle(json.loads(d))),
+        ("rle", json_encode(encode_rle), lambda d: decode_masks(json.loads(d))),
+        (
+            "packbits",
+            json_encode(encode_packbits),
+            lambda d: decode_masks(json.loads(d)),
+        ),
+    ]:
+        encode_time, data = timed(encode, masks)
+        decode_time, decoded = timed(decode, data)
+        assert all(
+            (a["segmentation"] == b["segmentation"]).all()
+            for a, b in zip(masks, decoded)
+        )
+        print(
+            f"{name:<10} {encode_time * 1000:>12.1f} {decode_time * 1000:>12.1f}"
+            f" {len(data) / 1024:>10.1f}"
+        )
@@ -0,0 +1,159 @@
+"""
+Exercises the fetcher of the SAM photon (see _Fetcher in sam.py) against a local
+HTTP server, without a GPU or the models. Run it next to sam.py with
+
+    python check_fetcher.py
+
+It checks that images are fetched and decoded, that oversized content is
+rejected whether or not the origin announces its size, that an origin trickling
+its content is cut off after max_seconds, and that checkpoint downloads resume
+after a dropped connection and are checked against their hash.
+"""
+
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import os
+import tempfile
+from threading import Thread
+import time
+
+import numpy as np
+from PIL import Image
+
+from sam import _Fetcher, SAM
+
+
+MAX_BYTES = 1 << 20
+MAX_SECONDS = 1.0
+CHECKPOINT = os.urandom(3 << 20)
+
+
+def png(width=64, height=48):
+    image = np.random.default_rng(0).integers(0, 256, (height, width, 3), np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(image).save(output, format="PNG")
+    return image, output.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    image = png()[1]
+    # The first full download of the checkpoint drops half way through.
+    checkpoint_drops = [True]
+    checkpoint_offsets = []
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, content, headers=()):
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == "/image.png":
+            self.send(200, self.image, [("Content-Length", len(self.image))])
+        elif self.path == "/large":
+            # Announces its size, which is rejected before reading anything.
+            self.send(200, b"", [("Content-Length", MAX_BYTES + 1)])
+        elif self.path == "/unsized":
+            # No Content-Length, the size is only known by reading.
+            self.send(200, b"\0" * (2 * MAX_BYTES))
+        elif self.path == "/slow":
+            # Every read completes well within the read timeout.
+            self.send_response(200)
+            self.end_headers()
+            try:
+                for _ in range(int(MAX_SECONDS * 10)):
+                    self.wfile.write(b"\0" * 16)
+                    self.wfile.flush()
+                    time.sleep(0.2)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up, which is the point.
+                pass
+        elif self.path == "/checkpoint":
+            self.checkpoint()
+        else:
+            self.send(404, b"")
+
+    def checkpoint(self):
+        offset = 0
+        if "Range" in self.headers:
+            offset = int(self.headers["Range"].split("=")[1].rstrip("-"))
+        self.checkpoint_offsets.append(offset)
+        if offset >= len(CHECKPOINT):
+            self.send(416, b"")
+            return
+        content = CHECKPOINT[offset:]
+        headers = [("Content-Length", len(content))]
+        if offset:
+            end = len(CHECKPOINT) - 1
+            headers.append(("Content-Range", f"bytes {offset}-{end}/{len(CHECKPOINT)}"))
+        self.send_response(206 if offset else 200)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if not offset and self.checkpoint_drops:
+            self.checkpoint_drops.pop()
+            self.wfile.write(content[: len(content) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(content)
+
+
+def expect(exception, fn, *args):
+    start = time.perf_counter()
+    try:
+        fn(*args)
+    except exception as e:
+        return time.perf_counter() - start, e
+    raise AssertionError(f"{fn.__name__}{args} did not raise {exception.__name__}")
+
+
+def check_fetch(fetcher, base):
+    image, _ = png()
+    assert np.array_equal(SAM._decode_image(fetcher.fetch(f"{base}/image.png")), image)
+    print("fetch: the image is fetched and decoded")
+
+    for path in ("/large", "/unsized"):
+        _, e = expect(ValueError, fetcher.fetch, base + path)
+        print(f"fetch: {path} rejected: {e}")
+
+    seconds, e = expect(TimeoutError, fetcher.fetch, f"{base}/slow")
+    assert seconds < MAX_SECONDS + 0.5, seconds
+    print(f"fetch: /slow cut off after {seconds:.2f}s: {e}")
+
+
+def check_download(fetcher, base):
+    sha256 = hashlib.sha256(CHECKPOINT).hexdigest()
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "checkpoint.pth")
+        fetcher.download(f"{base}/checkpoint", path, hash_prefix=sha256[:8])
+        with open(path, "rb") as f:
+            assert f.read() == CHECKPOINT
+        assert os.listdir(folder) == ["checkpoint.pth"]
+        offsets = Handler.checkpoint_offsets
+        assert len(offsets) == 2 and offsets[1] > 0, offsets
+        print(f"download: resumed at byte {offsets[1]} after a dropped connection")
+
+        os.remove(path)
+        _, e = expect(
+            RuntimeError, fetcher.download, f"{base}/checkpoint", path, "00000000"
+        )
+        assert os.listdir(folder) == [], os.listdir(folder)
+        print(f"download: a hash mismatch leaves no file behind: {e}")
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    fetcher = _Fetcher(
+        timeout=2, max_bytes=MAX_BYTES, pool_size=4, max_seconds=MAX_SECONDS
+    )
+    check_fetch(fetcher, base)
+    check_download(fetcher, base)
+    server.shutdown()
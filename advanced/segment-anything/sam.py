@@ -1,18 +1,579 @@
+import base64
+from collections import deque, OrderedDict
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import fcntl
+import hashlib
 import io
+import itertools
+import json
 import os
 import requests
-from urllib.request import urlopen
+import socket
+from threading import BoundedSemaphore, local, Lock, Timer
+import time
+from typing import List, Optional
+import zlib
 
 from loguru import logger
 
 import numpy as np
 from PIL import Image
 
-from leptonai.photon import Photon, HTTPException, PNGResponse
+from fastapi.responses import JSONResponse
+from leptonai.photon import (
+    FileParam,
+    HTTPException,
+    Photon,
+    PNGResponse,
+    StreamingResponse,
+)
 from leptonai.photon.types import lepton_pickle, LeptonPickled, lepton_unpickle
 
 from segment_anything import SamAutomaticMaskGenerator, SamPredictor, sam_model_registry
 import torch
+import torchvision
+
+
+# Mask encodings. Besides the default pickled numpy arrays, masks can be returned
+# as JSON, encoded either as COCO compressed RLE, or as the np.packbits bits of
+# the bounding box of the mask, compressed with zlib, in base64. The decode_*
+# functions below are standalone, so clients can copy them (or import this file)
+# to get the boolean masks back.
+MASK_FORMATS = ("pickle", "rle", "packbits")
+
+
+def _rle_counts(mask: np.ndarray) -> np.ndarray:
+    # Run lengths of alternating 0s and 1s over the column-major flattened mask,
+    # starting with 0s.
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.int64)
+
+
+def encode_rle(mask: np.ndarray) -> dict:
+    """
+    Encodes a boolean mask as COCO compressed RLE, the same string as
+    pycocotools.mask.encode, so pycocotools can decode it as well.
+    """
+    h, w = mask.shape
+    counts = _rle_counts(mask)
+    # From the fourth on, each count is stored relative to the count of the
+    # previous run of the same value, which is usually close for compact shapes.
+    x = counts.copy()
+    x[3:] -= counts[1:-2]
+    # Each value is then written in groups of 5 bits, least significant first, as
+    # characters from "0" on. All groups but the last have 0x20 set, and the
+    # value is sign extended from the top bit of the last group.
+    bits = np.frexp(np.where(x < 0, ~x, x).astype(np.float64))[1]
+    groups = (bits + 5) // 5
+    index = np.repeat(np.arange(len(x)), groups)
+    k = np.arange(len(index)) - np.repeat(np.cumsum(groups) - groups, groups)
+    chars = ((x[index] >> (5 * k)) & 0x1F) | np.where(k < groups[index] - 1, 0x20, 0)
+    return {"size": [h, w], "counts": (chars + 48).astype(np.uint8).tobytes().decode()}
+
+
+def decode_rle(rle: dict) -> np.ndarray:
+    """
+    Decodes COCO RLE, either compressed (counts is a string, see encode_rle) or
+    uncompressed (counts is a list of run lengths).
+    """
+    h, w = rle["size"]
+    counts = rle["counts"]
+    if isinstance(counts, str):
+        chars = np.frombuffer(counts.encode(), dtype=np.uint8).astype(np.int64) - 48
+        ends = np.flatnonzero((chars & 0x20) == 0)
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        groups = ends - starts + 1
+        k = np.arange(len(chars)) - np.repeat(starts, groups)
+        x = np.add.reduceat((chars & 0x1F) << (5 * k), starts)
+        x -= np.where(chars[ends] & 0x10, np.left_shift(1, 5 * groups), 0)
+        # Undo the relative encoding, separately for the runs of 0s and 1s.
+        counts = x
+        counts[1::2] = np.cumsum(x[1::2])
+        counts[2::2] = np.cumsum(x[2::2])
+    counts = np.asarray(counts, dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape((h, w), order="F")
+
+
+def encode_packbits(mask: np.ndarray) -> dict:
+    """
+    Encodes a boolean mask as the packed bits of its bounding box ("box", as x,
+    y, width, height), compressed with zlib.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    h, w = mask.shape
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows):
+        x, y = int(cols[0]), int(rows[0])
+        box = [x, y, int(cols[-1]) + 1 - x, int(rows[-1]) + 1 - y]
+    else:
+        box = [0, 0, 0, 0]
+    x, y, bw, bh = box
+    bits = zlib.compress(np.packbits(mask[y : y + bh, x : x + bw]), 6)
+    return {"size": [h, w], "box": box, "bits": base64.b64encode(bits).decode()}
+
+
+def decode_packbits(packed: dict) -> np.ndarray:
+    h, w = packed["size"]
+    x, y, bw, bh = packed.get("box", [0, 0, w, h])
+    bits = np.frombuffer(
+        zlib.decompress(base64.b64decode(packed["bits"])), dtype=np.uint8
+    )
+    mask = np.zeros((h, w), dtype=bool)
+    mask[y : y + bh, x : x + bw] = (
+        np.unpackbits(bits, count=bh * bw).reshape((bh, bw)).astype(bool)
+    )
+    return mask
+
+
+def decode_masks(annotations: list) -> list:
+    """
+    Client side helper: given the JSON output of an endpoint called with
+    format="rle" or format="packbits", replaces every encoded segmentation with
+    the boolean mask, in place, and returns the annotations.
+    """
+    for ann in annotations:
+        seg = ann["segmentation"]
+        ann["segmentation"] = (
+            decode_rle(seg) if "counts" in seg else decode_packbits(seg)
+        )
+    return annotations
+
+
+def render_overlay(
+    image: np.ndarray,
+    masks: list,
+    alpha: float = 0.35,
+    draw_contours: bool = False,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """
+    Draws the masks of the automatic mask generator in random colors on top of
+    an RGB uint8 image, with larger masks below smaller ones, and returns the
+    result as an RGB uint8 image. Pixels not covered by any mask are blended
+    with white.
+
+    Instead of blending every mask into a float image, we first build a single
+    integer label map (each mask only writes within its bounding box), and then
+    do one palette lookup and one fixed-point alpha blend in uint16 for the
+    whole image. The cost of the blend does not depend on the number of masks.
+    If draw_contours is set, the boundaries between labels are drawn in the
+    opaque mask color.
+    """
+    rng = rng or np.random.default_rng()
+    h, w = image.shape[:2]
+    sorted_anns = sorted(masks, key=(lambda x: x["area"]), reverse=True)
+    labels = np.zeros((h, w), dtype=np.uint16 if len(masks) < 2**16 else np.uint32)
+    for i, ann in enumerate(sorted_anns, 1):
+        x, y, bw, bh = (int(v) for v in ann["bbox"])
+        seg = ann["segmentation"][y : y + bh + 1, x : x + bw + 1]
+        labels[y : y + bh + 1, x : x + bw + 1][seg] = i
+    palette = rng.integers(0, 256, size=(len(sorted_anns) + 1, 3), dtype=np.uint8)
+    palette[0] = 255
+
+    colors = palette[labels]
+    a = int(round(alpha * 256))
+    out = (colors.astype(np.uint16) * a + image.astype(np.uint16) * (256 - a)) >> 8
+    out = out.astype(np.uint8)
+
+    if draw_contours:
+        edges = np.zeros((h, w), dtype=bool)
+        edges[:, :-1] |= labels[:, :-1] != labels[:, 1:]
+        edges[:-1, :] |= labels[:-1, :] != labels[1:, :]
+        edges &= labels > 0
+        out[edges] = colors[edges]
+    return out
+
+
+class _Fetcher:
+    """
+    Fetches remote content over a shared, pooled requests session, so that
+    connections to the same origin are reused across requests. Every request has
+    a (connect, read) timeout, and in-memory fetches are capped at ``max_bytes``
+    and ``max_seconds`` in total, so a slow or huge origin cannot hold a handler
+    forever or exhaust memory.
+    """
+
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(
+        self, timeout: float, max_bytes: int, pool_size: int, max_seconds: float
+    ):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch(self, url: str) -> bytes:
+        expired = []
+
+        def expire():
+            expired.append(True)
+            # Closing the response does not interrupt a read that is blocked on
+            # the socket, shutting the socket down does. The shutdown applies to
+            # the socket itself, so it can go through a duplicate descriptor.
+            try:
+                fd = os.dup(response.raw.fileno())
+                with socket.socket(fileno=fd) as sock:
+                    sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            # The read timeout applies to each read, so an origin that trickles
+            # the content could still take forever: the whole fetch is aborted
+            # once it takes longer than max_seconds.
+            timer = Timer(self.max_seconds, expire)
+            timer.start()
+            try:
+                response.raise_for_status()
+                length = response.headers.get("Content-Length")
+                if length is not None and int(length) > self.max_bytes:
+                    raise ValueError(
+                        f"content is {length} bytes, more than the"
+                        f" {self.max_bytes} allowed."
+                    )
+                data = bytearray()
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    data += chunk
+                    if len(data) > self.max_bytes:
+                        raise ValueError(
+                            f"content is more than {self.max_bytes} bytes."
+                        )
+            except Exception:
+                # Reads from a shut down socket fail in various ways.
+                if not expired:
+                    raise
+            finally:
+                timer.cancel()
+            if expired:
+                raise TimeoutError(
+                    f"fetching took more than {self.max_seconds} seconds."
+                )
+            return bytes(data)
+
+    def download(
+        self,
+        url: str,
+        path: str,
+        hash_prefix: Optional[str] = None,
+        retries: int = 5,
+    ) -> None:
+        """
+        Streams a (possibly large) file to disk chunk by chunk, without holding it
+        in memory, and without a size cap. The file is written to ``path + ".tmp"``
+        first: if the connection drops, the download resumes from where it stopped
+        with a range request, also across restarts. If ``hash_prefix`` is given,
+        the file is checked against it (see check_hash). The file only appears at
+        ``path`` once it is complete and verified.
+        """
+        tmp_path = path + ".tmp"
+        for attempt in range(retries + 1):
+            try:
+                self._download_remaining(url, tmp_path)
+                break
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"Download of {url} interrupted ({e}), resuming.")
+                time.sleep(min(2**attempt, 30))
+        if hash_prefix is not None and not self.check_hash(tmp_path, hash_prefix):
+            os.remove(tmp_path)
+            raise RuntimeError(f"{url} does not match its checksum {hash_prefix}.")
+        os.replace(tmp_path, path)
+
+    def _download_remaining(self, url: str, tmp_path: str) -> None:
+        offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.session.get(
+            url, stream=True, timeout=self.timeout, headers=headers
+        ) as response:
+            if offset and response.status_code == 416:
+                # Nothing left to download, the checksum tells whether the file is
+                # actually complete.
+                return
+            response.raise_for_status()
+            # Servers that don't support ranges send the whole file with a 200.
+            mode = "ab" if response.status_code == 206 else "wb"
+            with open(tmp_path, mode) as f:
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    f.write(chunk)
+
+    @classmethod
+    def check_hash(cls, path: str, hash_prefix: str) -> bool:
+        """
+        Checks that the content of the file at ``path`` has a digest starting with
+        ``hash_prefix``. Like torch.hub, this is meant for checkpoints that carry a
+        hash prefix in their file name. torch.hub uses sha256, while the SAM release
+        names use md5, so both digests are computed (in a single pass).
+        """
+        sha256, md5 = hashlib.sha256(), hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(cls.CHUNK_SIZE), b""):
+                sha256.update(chunk)
+                md5.update(chunk)
+        return any(
+            digest.hexdigest().startswith(hash_prefix) for digest in (sha256, md5)
+        )
+
+
+class _EmbeddingCache:
+    """
+    An LRU cache of SAM image embeddings, keyed by a content hash of the image and
+    bounded by the total size of the cached embeddings in bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._max_bytes = max_bytes
+        self._counters = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(image: np.ndarray) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str((image.shape, image.dtype.str)).encode())
+        h.update(np.ascontiguousarray(image).data)
+        return h.hexdigest()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return entry[0]
+
+    def put(self, key: str, state, size: int):
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (state, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), bytes=self._bytes)
+
+
+class _CachedSamPredictor(SamPredictor):
+    """
+    A SamPredictor that looks up the image embedding in an _EmbeddingCache before
+    running the (expensive) image encoder. Since SamAutomaticMaskGenerator calls
+    set_image() on its predictor, plugging this in makes repeated images only pay
+    for the (cheap) mask decoder. Keys are prefixed with the model type, since
+    embeddings of different model variants are not interchangeable.
+    """
+
+    def __init__(self, sam_model, cache: _EmbeddingCache, model_type: str):
+        super().__init__(sam_model)
+        self._cache = cache
+        self._model_type = model_type
+
+    def _key(self, image: np.ndarray, image_format: str) -> str:
+        return f"{self._model_type}:{self._cache.key(image)}{image_format}"
+
+    def set_image(self, image: np.ndarray, image_format: str = "RGB") -> None:
+        key = self._key(image, image_format)
+        state = self._cache.get(key)
+        if state is None:
+            super().set_image(image, image_format)
+            self._cache.put(
+                key,
+                self.get_state(),
+                self.features.element_size() * self.features.nelement(),
+            )
+        else:
+            self.set_state(state)
+        self.image_key = key
+
+    @torch.no_grad()
+    def cache_images(self, images: List[np.ndarray]) -> None:
+        """
+        Runs the image encoder on a batch of RGB images at once, and adds their
+        embeddings to the cache, so that a following set_image() on any of them
+        only restores the cached state. Images that are already cached are skipped.
+        """
+        pending = {}
+        for image in images:
+            key = self._key(image, "RGB")
+            if key not in self._cache and key not in pending:
+                pending[key] = image
+        if not pending:
+            return
+        # This mirrors SamPredictor.set_image: resize the long side to the encoder
+        # resolution, then normalize and pad to a square. After padding, all images
+        # have the same shape and can be stacked into one batch.
+        sizes, inputs = [], []
+        for image in pending.values():
+            transformed = self.transform.apply_image(image)
+            transformed = torch.as_tensor(transformed, device=self.device)
+            transformed = transformed.permute(2, 0, 1).contiguous()[None, :, :, :]
+            sizes.append((image.shape[:2], tuple(transformed.shape[-2:])))
+            inputs.append(self.model.preprocess(transformed))
+        features = self.model.image_encoder(torch.cat(inputs))
+        for key, (original_size, input_size), feature in zip(pending, sizes, features):
+            # Clone, so that each cached embedding owns its memory instead of
+            # keeping the whole batch alive.
+            feature = feature[None].clone()
+            self._cache.put(
+                key,
+                (feature, original_size, input_size),
+                feature.element_size() * feature.nelement(),
+            )
+
+    def get_state(self):
+        return (self.features, self.original_size, self.input_size)
+
+    def set_state(self, state) -> None:
+        self.reset_image()
+        self.features, self.original_size, self.input_size = state
+        self.is_image_set = True
+
+
+class _SamModel:
+    """
+    A loaded SAM variant, together with its predictors and the locks guarding them.
+    The predictors keep the current image embedding as state, so only one request
+    can use them at a time. The interactive predictor has its own lock, so that
+    prompt requests don't wait behind automatic generation. Tiled generation has
+    predictors of its own, and at most ``tile_slots`` tiles run at once, across all
+    tiled requests.
+    """
+
+    def __init__(
+        self, model_type: str, sam, cache: _EmbeddingCache, tile_slots: int = 1
+    ):
+        self.model_type = model_type
+        self.sam = sam
+        self.predictor = _CachedSamPredictor(sam, cache, model_type)
+        self.mask_generator = SamAutomaticMaskGenerator(sam)
+        self.mask_generator.predictor = _CachedSamPredictor(sam, cache, model_type)
+        self.model_lock = Lock()
+        self.predictor_lock = Lock()
+        self.tile_semaphore = BoundedSemaphore(tile_slots)
+        self.size_bytes = sum(
+            t.element_size() * t.nelement()
+            for t in itertools.chain(sam.parameters(), sam.buffers())
+        )
+
+
+class _ModelRegistry:
+    """
+    Loads SAM variants on demand and keeps them resident within a memory budget.
+    When loading a variant would exceed the budget, the least recently used
+    variants that are not pinned are unloaded. Concurrent requests for a variant
+    that is not loaded yet wait for a single load.
+    """
+
+    def __init__(self, loader, max_bytes: int, pinned=()):
+        self._loader = loader
+        self._max_bytes = max_bytes
+        self._pinned = set(pinned)
+        self._lock = Lock()
+        self._models = OrderedDict()
+        self._load_locks = {}
+        self._stats = {}
+
+    def _lookup(self, model_type: str):
+        model = self._models.get(model_type)
+        if model is not None:
+            self._models.move_to_end(model_type)
+            self._stats[model_type]["hits"] += 1
+        return model
+
+    def get(self, model_type: str) -> _SamModel:
+        with self._lock:
+            model = self._lookup(model_type)
+            if model is not None:
+                return model
+            load_lock = self._load_locks.setdefault(model_type, Lock())
+        with load_lock:
+            with self._lock:
+                model = self._lookup(model_type)
+                if model is not None:
+                    return model
+                stats = self._stats.setdefault(
+                    model_type,
+                    {"hits": 0, "loads": 0, "evictions": 0, "load_seconds": None},
+                )
+                # If we have loaded this variant before, we know its size and can
+                # make room before loading it, instead of briefly going over budget.
+                evicted = self._evict(stats.get("size_bytes", 0), model_type)
+            if evicted:
+                self._release_memory()
+            start = time.time()
+            model = self._loader(model_type)
+            load_seconds = time.time() - start
+            with self._lock:
+                self._models[model_type] = model
+                stats["loads"] += 1
+                stats["load_seconds"] = round(load_seconds, 3)
+                stats["size_bytes"] = model.size_bytes
+                evicted = self._evict(0, model_type)
+            if evicted:
+                self._release_memory()
+            return model
+
+    def _evict(self, incoming_bytes: int, keep: str) -> int:
+        total = incoming_bytes + sum(m.size_bytes for m in self._models.values())
+        evicted = 0
+        for model_type in list(self._models):
+            if total <= self._max_bytes:
+                break
+            if model_type == keep or model_type in self._pinned:
+                continue
+            logger.info(f"Unloading {model_type} to stay within the memory budget.")
+            total -= self._models.pop(model_type).size_bytes
+            self._stats[model_type]["evictions"] += 1
+            evicted += 1
+        return evicted
+
+    @staticmethod
+    def _release_memory():
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "budget_bytes": self._max_bytes,
+                "resident_bytes": sum(m.size_bytes for m in self._models.values()),
+                "models": {
+                    model_type: dict(
+                        stats,
+                        loaded=model_type in self._models,
+                        pinned=model_type in self._pinned,
+                    )
+                    for model_type, stats in self._stats.items()
+                },
+            }
 
 
 class SAM(Photon):
@@ -32,6 +593,18 @@ class SAM(Photon):
         "Pillow",
     ]
 
+    # The model itself is guarded by locks below, so concurrent requests can only
+    # overlap in what happens outside of the model: fetching and decoding images,
+    # and encoding results. A request holds its handler slot for its whole
+    # duration, including the fetch, so there are many more slots than the model
+    # can use at once: requests waiting on slow image origins (for at most
+    # FETCH_MAX_SECONDS each) then leave slots for requests that are ready to run
+    # on the GPU.
+    handler_max_concurrency = 16
+
+    # The maximum number of images in a single predict_batch request.
+    MAX_BATCH_IMAGES = 256
+
     # Similar to regular python, you can add custom member variables to the photon class.
     # In this case, we will specify where we can download the checkpoint for the model.
     # We will also specify where we will cache the checkpoint.
@@ -73,47 +646,207 @@ class SAM(Photon):
         #       https://www.lepton.ai/docs/advanced/storage
         self.local_cache_folder = os.environ.get("CACHE_FOLDER", "/tmp/sem-checkpoint")
 
+        # All remote content (images and the checkpoint) is fetched through a shared
+        # fetcher with connection pooling, timeouts (FETCH_TIMEOUT seconds per read)
+        # and limits for images (FETCH_MAX_MB, and FETCH_MAX_SECONDS in total).
+        # predict_batch reads images ahead on a pool of FETCH_WORKERS threads.
+        fetch_workers = int(os.environ.get("FETCH_WORKERS", 4))
+        self.fetcher = _Fetcher(
+            timeout=float(os.environ.get("FETCH_TIMEOUT", 10)),
+            max_bytes=int(os.environ.get("FETCH_MAX_MB", 50)) * 2**20,
+            pool_size=self.handler_max_concurrency + fetch_workers,
+            max_seconds=float(os.environ.get("FETCH_MAX_SECONDS", 30)),
+        )
+        self._fetch_pool = ThreadPoolExecutor(max_workers=fetch_workers)
+
+        # Running the image encoder is by far the most expensive part of SAM, and
+        # it only depends on the image. We therefore keep recent image embeddings
+        # in a cache (bounded by EMBEDDING_CACHE_MB), so that segmenting an image
+        # we have seen recently - e.g. calling predict_url and then generate_mask
+        # with the same url - only runs the mask decoder.
+        self.embedding_cache = _EmbeddingCache(
+            int(os.environ.get("EMBEDDING_CACHE_MB", 512)) * 2**20
+        )
+
+        # Besides the default MODEL_TYPE, requests can pick another variant with the
+        # model_type argument, e.g. the faster vit_b for interactive use. Variants
+        # are loaded on first use and kept in memory as long as they fit within
+        # MODEL_MEMORY_BUDGET_MB, unloading the least recently used ones otherwise.
+        # The default model is loaded right away, and is never unloaded.
+        # predict_tiled runs up to `workers` tiles of a request at once, each of
+        # them a full encoder pass on the GPU. TILE_CONCURRENCY bounds the number
+        # of tiles that run at once per variant, over all tiled requests, and with
+        # it the GPU memory they take.
+        self.tile_concurrency = int(os.environ.get("TILE_CONCURRENCY", 2))
+        self.models = _ModelRegistry(
+            self._load_model,
+            int(os.environ.get("MODEL_MEMORY_BUDGET_MB", 4096)) * 2**20,
+            pinned=[self.model_type],
+        )
+        self.models.get(self.model_type)
+
+        # Interactive sessions pin the embedding of their image, so that it is not
+        # evicted from the cache while a user is annotating it. Sessions are kept
+        # in LRU order, and at most MAX_SESSIONS are kept.
+        self._sessions = OrderedDict()
+        self._sessions_lock = Lock()
+        self._max_sessions = int(os.environ.get("MAX_SESSIONS", 16))
+
+    def _load_model(self, model_type: str) -> _SamModel:
         # Below is the utility code that downloads the checkpoint. Nothing fancy here,
         # just standard python code.
-        checkpoint_url = self.checkpoints[self.model_type]
+        checkpoint_url = self.checkpoints[model_type]
         target_checkpoint_path = os.path.join(
             self.local_cache_folder, os.path.basename(checkpoint_url)
         )
-        if not os.path.exists(target_checkpoint_path):
-            logger.info(
-                f"Downloading checkpoint from {checkpoint_url} to"
-                f" {target_checkpoint_path}."
-            )
-            # We will download the checkpoint to the local cache folder
-            os.makedirs(self.local_cache_folder, exist_ok=True)
-            # Download the checkpoint url to the local cache folder
-            # You can use any method to download the checkpoint
-            # For example, you can use `requests` or `wget`
-            # Here we use requests.
-            response = requests.get(checkpoint_url)
-            with open(target_checkpoint_path, "wb") as f:
-                f.write(response.content)
-        else:
-            logger.info(
-                f"Checkpoint already exists at {target_checkpoint_path}. Reusing it."
-            )
+        # The checkpoint names end with a prefix of their hash, e.g. "4b8939" in
+        # sam_vit_h_4b8939.pth, which we use to verify the download.
+        hash_prefix = os.path.splitext(target_checkpoint_path)[0].rsplit("_", 1)[-1]
+        os.makedirs(self.local_cache_folder, exist_ok=True)
+        # Several replicas may share the cache folder (e.g. on Lepton storage), so
+        # we take an exclusive lock on a lock file next to the checkpoint: only one
+        # replica downloads, and the others wait and then reuse its download.
+        with open(target_checkpoint_path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._ensure_checkpoint(
+                    checkpoint_url, target_checkpoint_path, hash_prefix
+                )
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-        # Now let's actually load the checkpoint. We'll load this into a member
-        # variable `sam`, so that we can use it later.
-        logger.info("Loading checkpoint. This might take some time.")
-        self.sam = sam_model_registry[self.model_type](
-            checkpoint=target_checkpoint_path
-        )
+        # Now let's actually load the checkpoint. Instead of reading the whole file
+        # into memory, we memory-map it, and let the model parameters use the mapped
+        # tensors directly (assign=True), so the weights are paged in from disk as
+        # they are needed, and the file's page cache is shared between processes.
+        logger.info(f"Loading {model_type} checkpoint. This might take some time.")
+        sam = sam_model_registry[model_type]()
+        try:
+            state_dict = torch.load(
+                target_checkpoint_path, map_location="cpu", mmap=True, weights_only=True
+            )
+            sam.load_state_dict(state_dict, assign=True)
+        except (RuntimeError, TypeError):
+            # Older torch versions, or checkpoints in the legacy (non-zip) format,
+            # cannot be memory-mapped.
+            sam.load_state_dict(torch.load(target_checkpoint_path, map_location="cpu"))
 
         # Check if we need to go to GPU. Torch provides a convenient way to check
         # if cuda is available - let's use that.
         if torch.cuda.is_available():
-            self.sam.to(device="cuda")
+            sam.to(device="cuda")
 
         # Similar to SAM's model itself, we will also create a predictor and a mask
-        # generator. We will use these later.
-        self.predictor = SamPredictor(self.sam)
-        self.mask_generator = SamAutomaticMaskGenerator(self.sam)
+        # generator, see _SamModel. We will use these later.
+        return _SamModel(
+            model_type, sam, self.embedding_cache, tile_slots=self.tile_concurrency
+        )
+
+    def _ensure_checkpoint(self, url: str, path: str, hash_prefix: str) -> None:
+        # Checkpoints downloaded by this photon only appear once complete and
+        # verified. A file placed there otherwise (e.g. by an older version of this
+        # photon) is verified once, and the result recorded in a marker file.
+        verified_marker = path + ".verified"
+        if os.path.exists(path):
+            if os.path.exists(verified_marker):
+                logger.info(f"Checkpoint already exists at {path}. Reusing it.")
+                return
+            if self.fetcher.check_hash(path, hash_prefix):
+                logger.info(f"Verified existing checkpoint at {path}. Reusing it.")
+                open(verified_marker, "w").close()
+                return
+            logger.warning(f"Checkpoint at {path} is corrupt, downloading it again.")
+            os.remove(path)
+        logger.info(f"Downloading checkpoint from {url} to {path}.")
+        # Download the checkpoint url to the local cache folder
+        # You can use any method to download the checkpoint
+        # For example, you can use `requests` or `wget`
+        # Here we use requests, streaming the file to disk instead of holding the
+        # whole checkpoint (2.5GB for vit_h) in memory, see _Fetcher.download.
+        self.fetcher.download(url, path, hash_prefix=hash_prefix)
+        open(verified_marker, "w").close()
+
+    def _model(self, model_type: Optional[str] = None) -> _SamModel:
+        """
+        Returns the requested model variant (the default one if None), loading it
+        if needed.
+        """
+        model_type = model_type or self.model_type
+        if model_type not in self.checkpoints:
+            raise HTTPException(
+                400,
+                f"Unsupported model_type {model_type}. Supported model types:"
+                f" {list(self.checkpoints)}",
+            )
+        return self.models.get(model_type)
+
+    @staticmethod
+    def _generate_masks(model: _SamModel, raw_img: np.ndarray):
+        with model.model_lock:
+            return model.mask_generator.generate(raw_img)
+
+    @staticmethod
+    def _check_format(format: str):
+        if format not in MASK_FORMATS:
+            raise HTTPException(
+                400, f"Unsupported format {format}. Supported formats: {MASK_FORMATS}"
+            )
+
+    @staticmethod
+    def _encode_masks(masks, format: str):
+        """
+        Serializes the output of the mask generator in the requested format. The
+        pickle format keeps the raw output, the other formats return JSON with
+        the encoded segmentation and plain python metadata per mask.
+        """
+        if format == "pickle":
+            return lepton_pickle(masks, compression=9)
+        return JSONResponse(SAM._masks_to_json(masks, format))
+
+    @staticmethod
+    def _masks_to_json(masks, format: str):
+        encode = encode_rle if format == "rle" else encode_packbits
+        return [
+            {
+                "segmentation": encode(ann["segmentation"]),
+                "area": int(ann["area"]),
+                "bbox": [float(x) for x in ann["bbox"]],
+                "predicted_iou": float(ann["predicted_iou"]),
+                "stability_score": float(ann["stability_score"]),
+                "point_coords": [[float(x) for x in p] for p in ann["point_coords"]],
+                "crop_box": [float(x) for x in ann["crop_box"]],
+            }
+            for ann in masks
+        ]
+
+    @staticmethod
+    def _decode_image(content: bytes) -> np.ndarray:
+        return np.asarray(Image.open(io.BytesIO(content)).convert("RGB"))
+
+    def _fetch_image(self, url: str) -> np.ndarray:
+        """
+        Fetches and decodes an RGB image. This runs on the handler thread: handing
+        it over to another thread would not release the handler slot, which is
+        held until the handler returns.
+        """
+        return self._decode_image(self.fetcher.fetch(url))
+
+    def _read_image(
+        self, url: Optional[str] = None, image: Optional[LeptonPickled] = None
+    ):
+        """
+        Reads an RGB image from either a url or a pickled numpy array, raising a 400
+        error if that is not possible.
+        """
+        try:
+            if url is not None:
+                return self._fetch_image(url)
+            elif image is not None:
+                return np.asarray(lepton_unpickle(image))
+            else:
+                raise ValueError("an image is required.")
+        except Exception as e:
+            raise HTTPException(400, f"Cannot read image: {str(e)}")
 
     # @Photon.handler() is a decorator that tells lepton that this function is
     # going to be exposed as an API endpoint. If no path is specified, the endpoint
@@ -133,20 +866,27 @@ class SAM(Photon):
             "url": "https://upload.wikimedia.org/wikipedia/commons/4/49/Koala_climbing_tree.jpg",
         },
     )
-    def predict_url(self, url: str) -> LeptonPickled:
+    def predict_url(
+        self, url: str, format: str = "pickle", model_type: Optional[str] = None
+    ) -> LeptonPickled:
         """
         This is the predict_url endpoint. It takes in an image url, calls the mask generator, and
         returns the masks. We also do proper error handling here: if the image cannot opened, or
         if the mask cannot be generated, we will return a proper http error back to the user side.
+
+        By default the masks are returned pickled. Pass format="rle" or format="packbits" to
+        get a much more compact JSON encoding instead, see decode_masks() for decoding it.
+        model_type selects the SAM variant (vit_h, vit_l or vit_b) to use instead of the
+        default one.
         """
+        self._check_format(format)
+        model = self._model(model_type)
 
-        # We will first download the image from the url. We will use the standard python
-        # urllib to do this. Note that this is just an example - you can use any method
-        # to download the image.
+        # We will first download the image from the url. We use a shared requests session
+        # with timeouts and a size limit to do this, see _Fetcher. Note that this is just an
+        # example - you can use any method to download the image.
         try:
-            raw_img = np.asarray(
-                Image.open(io.BytesIO(urlopen(url).read())).convert("RGB")
-            )
+            raw_img = self._fetch_image(url)
         except Exception as e:
             # HTTPException is a special exception that will be translated to a proper
             # http error by fastAPI and return to the user side. In this case, we will
@@ -162,7 +902,7 @@ class SAM(Photon):
         # block. If the model fails to run, we will return a 500 error code telling the user
         # that the model failed to run.
         try:
-            masks = self.mask_generator.generate(raw_img)
+            masks = self._generate_masks(model, raw_img)
         except Exception as e:
             raise HTTPException(
                 status_code=500,
@@ -189,8 +929,9 @@ class SAM(Photon):
         # Note that pickle comes with its own security risks - it may contain arbitrary code,
         # and it is prone to error when the client and server side are not using the same
         # python version. In real production scenarios, you might want to use a more robust
-        # serialization method.
-        return lepton_pickle(masks, compression=9)
+        # serialization method - which is what the "rle" and "packbits" formats do: they
+        # encode each boolean mask compactly, and send everything as plain JSON.
+        return self._encode_masks(masks, format)
 
     @Photon.handler(
         "generate_mask",
@@ -198,16 +939,23 @@ class SAM(Photon):
             "url": "https://upload.wikimedia.org/wikipedia/commons/4/49/Koala_climbing_tree.jpg",
         },
     )
-    def generate_mask(self, url: str) -> PNGResponse:
+    def generate_mask(
+        self,
+        url: str,
+        alpha: float = 0.35,
+        draw_contours: bool = False,
+        model_type: Optional[str] = None,
+    ) -> PNGResponse:
         """
         Generates a mask image for the segmentation result. This is similar to the predict_url
         endpoint, except that we will return a mask image instead of a python array of the raw
-        masks.
+        masks. alpha is the opacity of the masks, and draw_contours draws the mask boundaries.
         """
+        if not 0 <= alpha <= 1:
+            raise HTTPException(400, f"alpha must be in [0, 1], got {alpha}")
+        model = self._model(model_type)
         try:
-            raw_img = np.asarray(
-                Image.open(io.BytesIO(urlopen(url).read())).convert("RGB")
-            )
+            raw_img = self._fetch_image(url)
         except Exception as e:
             raise HTTPException(
                 status_code=400,
@@ -216,7 +964,7 @@ class SAM(Photon):
                 ),
             )
         try:
-            masks = self.mask_generator.generate(raw_img)
+            masks = self._generate_masks(model, raw_img)
         except Exception as e:
             raise HTTPException(
                 status_code=500,
@@ -226,20 +974,12 @@ class SAM(Photon):
                 ),
             )
 
-        # The below rendering code is copied from the segment-anything repo to draw the mask
-        # on top of the original image.
-        sorted_anns = sorted(masks, key=(lambda x: x["area"]), reverse=True)
-        mask_img = np.ones((
-            sorted_anns[0]["segmentation"].shape[0],
-            sorted_anns[0]["segmentation"].shape[1],
-            3,
-        ))
-        for ann in sorted_anns:
-            mask_img[ann["segmentation"]] = np.random.random(3)
-        alpha = 0.35
-        img = mask_img * alpha + (raw_img.astype(float) / 255) * (1 - alpha)
+        # Draw the masks on top of the original image. This follows the rendering code of
+        # the segment-anything repo, but works on integer labels instead of float images,
+        # see render_overlay for details.
+        img = render_overlay(raw_img, masks, alpha=alpha, draw_contours=draw_contours)
         # Convert the img numpy class to an image io that we can use to send back to the client
-        img = Image.fromarray((img * 255).astype(np.uint8))
+        img = Image.fromarray(img)
         img_byte_array = io.BytesIO()
         img.save(img_byte_array, format="PNG")
         img_byte_array.seek(0)
@@ -248,20 +988,456 @@ class SAM(Photon):
         # correct content type for the response.
         return PNGResponse(img_byte_array)
 
+    @Photon.handler(
+        "predict_prompts",
+        example={
+            "url": "https://upload.wikimedia.org/wikipedia/commons/4/49/Koala_climbing_tree.jpg",
+            "points": [[500, 375]],
+            "point_labels": [1],
+        },
+    )
+    def predict_prompts(
+        self,
+        url: Optional[str] = None,
+        image: Optional[LeptonPickled] = None,
+        image_id: Optional[str] = None,
+        session_id: Optional[str] = None,
+        points: Optional[List[List[float]]] = None,
+        point_labels: Optional[List[int]] = None,
+        boxes: Optional[List[List[float]]] = None,
+        multimask_output: bool = True,
+        format: str = "pickle",
+        model_type: Optional[str] = None,
+    ) -> LeptonPickled:
+        """
+        Interactive segmentation with point and/or box prompts. Instead of running
+        the automatic mask generator (which decodes masks for a whole grid of
+        points), this runs the mask decoder only for the given prompts, which takes
+        milliseconds once the image embedding is computed.
+
+        The image is given either as a ``url``, a pickled ``image`` array, or the
+        ``image_id`` returned by a previous call. ``points`` are [x, y] pixel
+        coordinates with ``point_labels`` 1 (foreground) or 0 (background), and
+        ``boxes`` are [x0, y0, x1, y1]. With multiple boxes, one set of masks is
+        predicted per box (sharing the points, if any).
+
+        If ``session_id`` is given, the image embedding is pinned to the session,
+        so follow-up calls with the same session_id need neither the image nor the
+        image_id. Call end_session to release it. An image_id is only valid for the
+        ``model_type`` it was computed with.
+
+        Returns a pickled dict with the ``image_id``, the ``masks`` as a boolean
+        array of shape [num_boxes or 1, num_masks, H, W] and their ``scores``.
+        With format="rle" or format="packbits", the same dict is returned as JSON,
+        with ``masks`` as nested lists of encoded masks.
+        """
+        self._check_format(format)
+        if not points and not boxes:
+            raise HTTPException(400, "At least one of points or boxes is required.")
+        if points and (point_labels is None or len(points) != len(point_labels)):
+            raise HTTPException(
+                400, "point_labels must be given for, and match, the points."
+            )
+        model = self._model(model_type)
+        prefix = f"{model.model_type}:"
+
+        state = None
+        if session_id is not None:
+            with self._sessions_lock:
+                if session_id in self._sessions:
+                    self._sessions.move_to_end(session_id)
+                    pinned_id, pinned_state = self._sessions[session_id]
+                    if (
+                        image_id in (None, pinned_id)
+                        and pinned_id.startswith(prefix)
+                        and url is None
+                        and image is None
+                    ):
+                        image_id, state = pinned_id, pinned_state
+        if state is None and image_id is not None:
+            if not image_id.startswith(prefix):
+                raise HTTPException(
+                    400,
+                    f"Image {image_id} was not computed with model_type"
+                    f" {model.model_type}.",
+                )
+            state = self.embedding_cache.get(image_id)
+            if state is None:
+                raise HTTPException(
+                    404,
+                    f"Image {image_id} is no longer cached. Please send the image"
+                    " again.",
+                )
+
+        raw_img = None
+        if state is None:
+            raw_img = self._read_image(url, image)
+
+        try:
+            with model.predictor_lock:
+                if state is None:
+                    model.predictor.set_image(raw_img)
+                    image_id, state = (
+                        model.predictor.image_key,
+                        model.predictor.get_state(),
+                    )
+                else:
+                    model.predictor.set_state(state)
+                masks, scores = self._predict_prompts(
+                    model.predictor, points, point_labels, boxes, multimask_output
+                )
+        except Exception as e:
+            raise HTTPException(
+                500, f"Cannot predict masks. Detailed error message: {str(e)}"
+            )
+
+        if session_id is not None:
+            with self._sessions_lock:
+                self._sessions[session_id] = (image_id, state)
+                self._sessions.move_to_end(session_id)
+                while len(self._sessions) > self._max_sessions:
+                    self._sessions.popitem(last=False)
+
+        if format == "pickle":
+            return lepton_pickle(
+                {"image_id": image_id, "masks": masks, "scores": scores}, compression=1
+            )
+        encode = encode_rle if format == "rle" else encode_packbits
+        return JSONResponse({
+            "image_id": image_id,
+            "masks": [[encode(m) for m in per_prompt] for per_prompt in masks],
+            "scores": scores.tolist(),
+        })
+
+    @staticmethod
+    def _predict_prompts(predictor, points, point_labels, boxes, multimask_output):
+        # Prompts are given in original image coordinates, and need to be
+        # transformed to the resized input frame of the model, just like
+        # SamPredictor.predict() does for a single prompt.
+        coords, labels, boxes_t = None, None, None
+        if points:
+            coords = predictor.transform.apply_coords_torch(
+                torch.as_tensor(points, dtype=torch.float, device=predictor.device),
+                predictor.original_size,
+            )[None]
+            labels = torch.as_tensor(
+                point_labels, dtype=torch.int, device=predictor.device
+            )[None]
+        if boxes:
+            boxes_t = predictor.transform.apply_boxes_torch(
+                torch.as_tensor(boxes, dtype=torch.float, device=predictor.device),
+                predictor.original_size,
+            )
+            if coords is not None:
+                coords = coords.repeat(len(boxes), 1, 1)
+                labels = labels.repeat(len(boxes), 1)
+        masks, scores, _ = predictor.predict_torch(
+            coords, labels, boxes_t, multimask_output=multimask_output
+        )
+        return masks.cpu().numpy(), scores.cpu().numpy()
+
+    @Photon.handler(
+        "predict_tiled",
+        example={
+            "url": "https://upload.wikimedia.org/wikipedia/commons/4/49/Koala_climbing_tree.jpg",
+            "tile_size": 512,
+            "tile_overlap": 64,
+        },
+    )
+    def predict_tiled(
+        self,
+        url: Optional[str] = None,
+        image: Optional[LeptonPickled] = None,
+        tile_size: int = 1024,
+        tile_overlap: int = 128,
+        points_per_side: int = 32,
+        workers: int = 1,
+        nms_threshold: float = 0.7,
+        stream: bool = False,
+        format: str = "rle",
+        model_type: Optional[str] = None,
+    ):
+        """
+        Automatic mask generation for very large images (aerial imagery, scanned
+        documents, ...). SAM resizes its input to 1024 pixels on the long side, so
+        on a multi-megapixel image small objects are lost. Instead, we split the
+        image into overlapping tiles of ``tile_size`` pixels, run the mask generator
+        with ``points_per_side`` on each tile, optionally on a pool of ``workers``
+        threads, and merge masks across tile boundaries with non-maximum
+        suppression on their boxes. Masks cut by an interior tile edge rank below
+        complete masks, so an object in the overlap is kept from the tile that
+        sees it whole. Every tile in flight is an encoder pass on the GPU, so the
+        tiles of all requests share TILE_CONCURRENCY slots per model, whatever
+        ``workers`` is.
+
+        To keep memory bounded, every segmentation is relative to the tile it was
+        found in, given by its "crop_box" ([x, y, w, h] in image coordinates),
+        while "bbox" and "point_coords" are in image coordinates. ``format`` is
+        "rle" or "packbits".
+
+        If ``stream`` is set, the response is newline delimited JSON with one
+        line per tile, {"tile": [x, y, w, h], "masks": [...]}, sent as soon as the
+        tile finishes. Streamed masks are deduplicated against the masks already
+        sent, so a mask is never retracted, but the result may differ slightly
+        from the non-streaming one.
+        """
+        if format not in ("rle", "packbits"):
+            raise HTTPException(400, "format must be rle or packbits.")
+        if tile_size < 256 or not 0 <= tile_overlap < tile_size // 2:
+            raise HTTPException(
+                400, "tile_size must be >= 256, and tile_overlap in [0, tile_size/2)."
+            )
+        if not 1 <= points_per_side <= 64 or not 1 <= workers <= 8:
+            raise HTTPException(
+                400, "points_per_side must be in [1, 64], and workers in [1, 8]."
+            )
+        model = self._model(model_type)
+        raw_img = self._read_image(url, image)
+        h, w = raw_img.shape[:2]
+
+        def starts(length):
+            step = tile_size - tile_overlap
+            result = list(range(0, max(length - tile_size, 0) + 1, step))
+            if result[-1] + tile_size < length:
+                result.append(length - tile_size)
+            return result
+
+        tiles = [(x, y) for y in starts(h) for x in starts(w)]
+        # Every worker thread gets its own mask generator, since the predictor inside
+        # it holds the current image embedding. They share the model weights. Tiles
+        # use a plain SamPredictor rather than the embedding cache: one large image
+        # has dozens of tiles, whose embeddings would evict the cached embeddings of
+        # whole images, and with them the image_ids of predict_prompts.
+        generators = local()
+
+        def run_tile(x, y):
+            if not hasattr(generators, "generator"):
+                generators.generator = SamAutomaticMaskGenerator(
+                    model.sam, points_per_side=points_per_side
+                )
+            tile = raw_img[y : y + tile_size, x : x + tile_size]
+            th, tw = tile.shape[:2]
+            with model.tile_semaphore:
+                masks = generators.generator.generate(tile)
+            for ann in masks:
+                bx, by, bw, bh = ann["bbox"]
+                # Whether the mask touches a tile edge that is not an image edge.
+                cut = (
+                    (bx <= 1 and x > 0)
+                    or (by <= 1 and y > 0)
+                    or (bx + bw >= tw - 2 and x + tw < w)
+                    or (by + bh >= th - 2 and y + th < h)
+                )
+                ann["bbox"] = [bx + x, by + y, bw, bh]
+                ann["point_coords"] = [
+                    [px + x, py + y] for px, py in ann["point_coords"]
+                ]
+                ann["crop_box"] = [x, y, tw, th]
+                ann["_score"] = ann["predicted_iou"] - (1.0 if cut else 0.0)
+            return [x, y, tw, th], masks
+
+        def boxes_xyxy(masks):
+            return torch.tensor(
+                [
+                    [bx, by, bx + bw, by + bh]
+                    for bx, by, bw, bh in (m["bbox"] for m in masks)
+                ],
+                dtype=torch.float,
+            ).reshape(-1, 4)
+
+        def run_tiles():
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(run_tile, x, y) for x, y in tiles]
+                for future in as_completed(futures):
+                    yield future.result()
+
+        if not stream:
+            masks = [m for _, tile_masks in run_tiles() for m in tile_masks]
+            if masks:
+                keep = torchvision.ops.nms(
+                    boxes_xyxy(masks),
+                    torch.tensor([m["_score"] for m in masks]),
+                    nms_threshold,
+                )
+                masks = [masks[i] for i in keep.tolist()]
+            return JSONResponse(self._masks_to_json(masks, format))
+
+        def stream_tiles():
+            kept = torch.zeros((0, 4))
+            for tile_box, masks in run_tiles():
+                masks = sorted(masks, key=lambda m: m["_score"], reverse=True)
+                selected = []
+                for mask, box in zip(masks, boxes_xyxy(masks)):
+                    box = box[None]
+                    if (
+                        len(kept)
+                        and torchvision.ops.box_iou(box, kept).max() > nms_threshold
+                    ):
+                        continue
+                    kept = torch.cat([kept, box])
+                    selected.append(mask)
+                line = {
+                    "tile": tile_box,
+                    "masks": self._masks_to_json(selected, format),
+                }
+                yield json.dumps(line) + "\n"
+
+        return StreamingResponse(stream_tiles(), media_type="application/x-ndjson")
+
+    @Photon.handler(
+        "predict_batch",
+        example={
+            "urls": [
+                "https://upload.wikimedia.org/wikipedia/commons/4/49/Koala_climbing_tree.jpg",
+            ],
+        },
+    )
+    def predict_batch(
+        self,
+        urls: Optional[List[str]] = None,
+        files: Optional[List[FileParam]] = None,
+        images: Optional[List[LeptonPickled]] = None,
+        batch_size: int = 4,
+        stream: bool = False,
+        format: str = "rle",
+        model_type: Optional[str] = None,
+    ):
+        """
+        Automatic mask generation for many images in one request, e.g. for offline
+        labeling jobs. The images are given as ``urls``, uploaded ``files`` and/or
+        pickled ``images`` arrays, and are numbered in that order. They are read on
+        the fetch pool ahead of the model, and the image encoder runs on batches of
+        ``batch_size`` images at once; masks are then decoded per image.
+
+        Returns a JSON list with one {"index": i, "masks": [...]} per image, in
+        request order. An image that cannot be read or segmented gets
+        {"index": i, "error": "..."} instead, without failing the others. If
+        ``stream`` is set, the response is newline delimited JSON with one such
+        line per image, sent as soon as the image is done. ``format`` is "rle" or
+        "packbits".
+        """
+        if format not in ("rle", "packbits"):
+            raise HTTPException(400, "format must be rle or packbits.")
+        if not 1 <= batch_size <= 16:
+            raise HTTPException(400, "batch_size must be in [1, 16].")
+        items = (
+            [(self.fetcher.fetch, url) for url in urls or []]
+            + [(lambda f: f.content, f) for f in files or []]
+            + [(None, image) for image in images or []]
+        )
+        if not items:
+            raise HTTPException(400, "At least one image is required.")
+        if len(items) > self.MAX_BATCH_IMAGES:
+            raise HTTPException(
+                400, f"At most {self.MAX_BATCH_IMAGES} images are supported."
+            )
+        model = self._model(model_type)
+
+        def read(get_content, item):
+            if get_content is None:
+                return np.asarray(lepton_unpickle(item))
+            return self._decode_image(get_content(item))
+
+        def results():
+            # Keep at most two batches of images in flight on the fetch pool, so
+            # that reading the next batch overlaps with running the current one
+            # without holding all images in memory.
+            reads = deque()
+            pending = iter(items)
+
+            def read_ahead():
+                for get_content, item in itertools.islice(
+                    pending, max(2 * batch_size - len(reads), 0)
+                ):
+                    reads.append(self._fetch_pool.submit(read, get_content, item))
+
+            index = 0
+            read_ahead()
+            while reads:
+                batch = []
+                while reads and len(batch) < batch_size:
+                    try:
+                        batch.append((index, reads.popleft().result(), None))
+                    except Exception as e:
+                        batch.append((index, None, f"Cannot read image: {str(e)}"))
+                    index += 1
+                read_ahead()
+                yield from self._predict_batch(model, batch, format)
+
+        if not stream:
+            return JSONResponse(list(results()))
+        return StreamingResponse(
+            (json.dumps(result) + "\n" for result in results()),
+            media_type="application/x-ndjson",
+        )
+
+    def _predict_batch(self, model: _SamModel, batch, format: str):
+        # Encode all readable images of the batch in one forward pass. The mask
+        # generator then finds their embeddings in the cache. If the batch does not
+        # fit (e.g. out of GPU memory), every image is simply encoded on its own.
+        raw_imgs = [raw_img for _, raw_img, _ in batch if raw_img is not None]
+        try:
+            with model.model_lock:
+                model.mask_generator.predictor.cache_images(raw_imgs)
+        except Exception as e:
+            logger.warning(f"Batched image encoding failed: {str(e)}")
+        for index, raw_img, error in batch:
+            if error is None:
+                try:
+                    masks = self._generate_masks(model, raw_img)
+                    yield {"index": index, "masks": self._masks_to_json(masks, format)}
+                    continue
+                except Exception as e:
+                    error = f"Cannot generate mask: {str(e)}"
+            yield {"index": index, "error": error}
+
+    @Photon.handler("end_session")
+    def end_session(self, session_id: str) -> bool:
+        """
+        Releases the image embedding pinned by an interactive session. Returns
+        whether the session existed.
+        """
+        with self._sessions_lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    @Photon.handler("embedding_cache_stats")
+    def embedding_cache_stats(self) -> dict:
+        """
+        Returns the hit/miss counters and the size of the image embedding cache.
+        """
+        return self.embedding_cache.stats()
+
+    @Photon.handler("model_stats")
+    def model_stats(self) -> dict:
+        """
+        Returns the memory budget and, per model variant that has been requested,
+        whether it is loaded, its resident size in bytes, how long it took to load,
+        and how often it was loaded, used while loaded, and unloaded.
+        """
+        return self.models.stats()
+
     @Photon.handler("seg_from_pickle")
-    def seg_from_pickle(self, image: LeptonPickled) -> LeptonPickled:
+    def seg_from_pickle(
+        self,
+        image: LeptonPickled,
+        format: str = "pickle",
+        model_type: Optional[str] = None,
+    ) -> LeptonPickled:
         """
         This is an example of how to use the leptonai sdk to send a complex data structure
         to the server side. In this case, we will send a pickled data structure to the server
-        side, and the server side will unpickle it and run the model.
+        side, and the server side will unpickle it and run the model. See predict_url for
+        the format and model_type arguments.
         """
+        self._check_format(format)
+        model = self._model(model_type)
         try:
             raw_img = np.asarray(lepton_unpickle(image))
         except Exception:
             raise HTTPException(status_code=400, detail="Cannot read image from bytes.")
 
         try:
-            masks = self.mask_generator.generate(raw_img)
+            masks = self._generate_masks(model, raw_img)
         except Exception as e:
             print(e)
             raise HTTPException(
@@ -271,7 +1447,7 @@ class SAM(Photon):
                 ),
             )
 
-        return lepton_pickle(masks, compression=9)
+        return self._encode_masks(masks, format)
 
 
 if __name__ == "__main__":
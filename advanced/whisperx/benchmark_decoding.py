@@ -0,0 +1,100 @@
+"""
+Compares the time it takes to decode an upload into the 16kHz mono waveform that
+WhisperX works on, per minute of audio:
+
+- "tempfile": what the photon used to do, writing the upload to a temporary file
+  and running ffmpeg on it the way whisperx.load_audio does.
+- "memory": decode_audio from main.py, which decodes 16kHz mono WAV files in-process
+  and pipes the formats below into ffmpeg (MP4 files still go through a temporary
+  file, as ffmpeg may need to seek in them).
+
+Run it next to main.py with
+
+    python benchmark_decoding.py [minutes]
+
+It needs ffmpeg, but neither a GPU nor the models. The input is synthetic audio,
+encoded by ffmpeg to each format.
+"""
+
+from io import BytesIO
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+from main import decode_audio
+
+
+# (label, ffmpeg output arguments), None for the 16kHz mono WAV file itself.
+FORMATS = [
+    ("wav, 16kHz mono", None),
+    ("wav, 44.1kHz stereo", ["-f", "wav", "-ar", "44100", "-ac", "2"]),
+    ("flac, 16kHz mono", ["-f", "flac"]),
+    ("mp3, 128kbps", ["-f", "mp3", "-b:a", "128k"]),
+]
+
+
+def synthetic_wav(minutes, sample_rate=16000, seed=0):
+    # A few tones under noise, so that the compressed formats have some work to do.
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(minutes * 60 * sample_rate)) / sample_rate
+    audio = 0.05 * rng.standard_normal(t.size)
+    for frequency in (220, 440, 1250):
+        audio += 0.2 * np.sin(2 * np.pi * frequency * t)
+    samples = (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+    output = BytesIO()
+    with wave.open(output, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+    return output.getvalue()
+
+
+def encode(content, args):
+    return subprocess.run(
+        ["ffmpeg", "-i", "pipe:0", "-loglevel", "error"] + args + ["-"],
+        input=content,
+        capture_output=True,
+        check=True,
+    ).stdout
+
+
+def decode_tempfile(content, sample_rate=16000):
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(content)
+        f.flush()
+        # The same as whisperx.load_audio.
+        cmd = ["ffmpeg", "-nostdin", "-threads", "0", "-i", f.name]
+        cmd += ["-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le"]
+        cmd += ["-ar", str(sample_rate), "-"]
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def benchmark(fn, content, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        audio = fn(content)
+        times.append(time.perf_counter() - start)
+    return min(times), audio
+
+
+if __name__ == "__main__":
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    wav = synthetic_wav(minutes)
+    print(f"{minutes:g} minutes of audio, decode time in ms per audio minute")
+    print(f"{'format':<22} {'size (MB)':>10} {'tempfile':>10} {'memory':>10}")
+    for label, args in FORMATS:
+        content = wav if args is None else encode(wav, args)
+        baseline, expected = benchmark(decode_tempfile, content)
+        seconds, audio = benchmark(decode_audio, content)
+        assert np.array_equal(audio, expected)
+        print(
+            f"{label:<22} {len(content) / 2**20:>10.1f}"
+            f" {baseline / minutes * 1000:>10.1f} {seconds / minutes * 1000:>10.1f}"
+        )
@@ -1,12 +1,28 @@
+from collections import deque, OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, wait
+import hashlib
+import itertools
+import json
 import os
+import pickle
+import struct
+import subprocess
 import sys
+import tempfile
 import time
 from typing import List, Optional, Union
+import uuid
 
-from threading import Lock
+from threading import Condition, Event, Lock, Thread
 import numpy as np
 
-from leptonai.photon import Photon, FileParam, HTTPException, get_file_content
+from leptonai.photon import (
+    Photon,
+    FileParam,
+    HTTPException,
+    StreamingResponse,
+    get_file_content,
+)
 from loguru import logger
 
 # Note: instead of importing whisperx in the main file, we import it in the functions that
@@ -15,12 +31,519 @@ from loguru import logger
 # import whisperx
 
 
+def _decode_wav(content: bytes, sample_rate: int) -> Optional[np.ndarray]:
+    """
+    Returns the int16 samples of a mono 16-bit PCM WAV file at ``sample_rate`` as a view
+    into ``content``, or None if content is anything else.
+    """
+    if len(content) < 12 or content[:4] != b"RIFF" or content[8:12] != b"WAVE":
+        return None
+    offset, fmt = 12, None
+    while offset + 8 <= len(content):
+        chunk_id, size = struct.unpack_from("<4sI", content, offset)
+        offset += 8
+        if chunk_id == b"fmt " and size >= 16:
+            fmt = struct.unpack_from("<HHIIHH", content, offset)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            audio_format, channels, rate, _, _, bits = fmt
+            if (audio_format, channels, rate, bits) != (1, 1, sample_rate, 16):
+                return None
+            # Streamed WAV files may not have the size filled in.
+            count = min(size, len(content) - offset) // 2
+            return np.frombuffer(content, np.int16, count=count, offset=offset)
+        offset += size + size % 2
+    return None
+
+
+def _feed_stdin(process: subprocess.Popen, content: bytes):
+    """
+    Writes content to the stdin of process from a separate thread, so that its
+    stdout can be read at the same time without deadlocking on full pipes.
+    """
+
+    def feed():
+        try:
+            process.stdin.write(content)
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # ffmpeg exited early, e.g. because the input is not audio.
+            pass
+
+    Thread(target=feed, daemon=True).start()
+
+
+def _drain_stderr(process: subprocess.Popen, max_bytes: int = 1 << 16):
+    """
+    Reads the stderr of process from a separate thread, so that ffmpeg cannot block on
+    a full pipe, and returns a function that waits for the end of the output and
+    returns its last ``max_bytes`` bytes as text.
+    """
+    tail = bytearray()
+
+    def drain():
+        for line in process.stderr:
+            tail.extend(line)
+            del tail[:-max_bytes]
+
+    thread = Thread(target=drain, daemon=True)
+    thread.start()
+
+    def result() -> str:
+        thread.join()
+        return tail.decode(errors="replace").strip()
+
+    return result
+
+
+def _is_iso_bmff(content: bytes) -> bool:
+    """
+    Returns whether content is an MP4, M4A or MOV file. Their index (the moov box)
+    may come after the media data, where ffmpeg cannot reach it from a pipe.
+    """
+    return content[4:8] == b"ftyp"
+
+
+def _run_ffmpeg(source: str, content: Optional[bytes], sample_rate: int) -> np.ndarray:
+    """
+    Decodes source (a path, or "pipe:0" to pipe in content) into int16 mono samples at
+    ``sample_rate`` with ffmpeg, whose output is read into a preallocated buffer
+    without intermediate copies. Raises RuntimeError if ffmpeg fails.
+    """
+    process = subprocess.Popen(
+        ["ffmpeg", "-threads", "0", "-i", source]
+        + ["-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le"]
+        + ["-ar", str(sample_rate), "-loglevel", "error", "-"],
+        stdin=subprocess.DEVNULL if content is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if content is not None:
+        _feed_stdin(process, content)
+    error = _drain_stderr(process)
+    # Compressed audio usually decodes to a few times its size. The buffer is not
+    # initialized, so untouched pages cost nothing, and it doubles whenever it is
+    # full, so a bad guess only costs a few copies.
+    buffer = np.empty(max(2 * len(content or b""), 1 << 20), dtype=np.uint8)
+    size = 0
+    while True:
+        if size == len(buffer):
+            buffer = np.concatenate([buffer, np.empty_like(buffer)])
+        read = process.stdout.readinto(buffer[size:])
+        if not read:
+            break
+        size += read
+    if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg cannot decode the input: {error()}")
+    return buffer[: size // 2 * 2].view(np.int16)
+
+
+def decode_audio(content: bytes, sample_rate: int = 16000) -> np.ndarray:
+    """
+    Decodes an audio file into a float32 mono waveform at ``sample_rate``, the same as
+    whisperx.load_audio but from the file content in memory instead of a file path.
+    WAV files that are already 16-bit mono at ``sample_rate`` are decoded in-process;
+    anything else is piped into ffmpeg. Inputs that ffmpeg can only read from a
+    seekable file (MP4 files, or anything it fails to decode from the pipe) are
+    written to a temporary file first.
+    """
+    samples = _decode_wav(content, sample_rate)
+    if samples is None and not _is_iso_bmff(content):
+        try:
+            samples = _run_ffmpeg("pipe:0", content, sample_rate)
+        except RuntimeError as e:
+            logger.debug(f"Retrying to decode from a file: {e}")
+    if samples is None:
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            samples = _run_ffmpeg(f.name, None, sample_rate)
+    audio = samples.astype(np.float32)
+    audio /= 32768.0
+    return audio
+
+
+class _SegmentBatcher:
+    """
+    Runs the whisper model on batches of VAD segments pooled from all in-flight
+    requests, so that many short clips fill a batch together instead of each
+    running a mostly empty batch on its own.
+
+    Segments are grouped by language, since the decoder prompt depends on it. A
+    single worker thread runs the batches: whenever it is free, it takes up to
+    ``max_batch_size`` pending segments of the language of the oldest pending
+    segment, in arrival order. While one batch runs, the next one fills up.
+    ``run_fn(language, features)`` receives a list of log-mel features and returns
+    one text per feature.
+
+    Segments submitted with ``background=True`` (asynchronous jobs) only lead a
+    batch when no other segment is pending, and otherwise only fill the room left
+    in a batch of their language, so that long jobs do not hold up requests.
+    """
+
+    def __init__(self, run_fn, max_batch_size: int):
+        self._run_fn = run_fn
+        self._max_batch_size = max(1, max_batch_size)
+        # (language, features, future), in arrival order.
+        self._pending = deque()
+        self._background = deque()
+        self._cv = Condition()
+        self._counters = {"batches": 0, "segments": 0}
+        Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, language: str, features, background: bool = False) -> Future:
+        future = Future()
+        with self._cv:
+            queue = self._background if background else self._pending
+            queue.append((language, features, future))
+            self._cv.notify()
+        return future
+
+    def stats(self):
+        with self._cv:
+            batches = self._counters["batches"]
+            return dict(
+                self._counters,
+                pending=len(self._pending),
+                background_pending=len(self._background),
+                mean_batch_size=self._counters["segments"] / batches if batches else 0,
+            )
+
+    def _next_batch(self):
+        with self._cv:
+            while not self._pending and not self._background:
+                self._cv.wait()
+            language = (self._pending or self._background)[0][0]
+            batch = []
+            self._pending = self._take(self._pending, language, batch)
+            self._background = self._take(self._background, language, batch)
+            return language, batch
+
+    def _take(self, queue: deque, language: str, batch: list) -> deque:
+        """
+        Moves the segments of language from queue to batch, as long as the batch is
+        not full, and returns the rest of queue.
+        """
+        rest = deque()
+        for item in queue:
+            if item[0] == language and len(batch) < self._max_batch_size:
+                batch.append(item)
+            else:
+                rest.append(item)
+        return rest
+
+    def _loop(self):
+        while True:
+            language, batch = self._next_batch()
+            # Segments of requests that gave up are dropped.
+            batch = [
+                (features, future)
+                for _, features, future in batch
+                if future.set_running_or_notify_cancel()
+            ]
+            if not batch:
+                continue
+            try:
+                texts = self._run_fn(language, [features for features, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), text in zip(batch, texts):
+                future.set_result(text)
+            with self._cv:
+                self._counters["batches"] += 1
+                self._counters["segments"] += len(batch)
+
+
+class _AlignModelPool:
+    """
+    Keeps the (language specific) alignment models loaded within a memory budget.
+    Models are loaded on first use with ``loader(language)``, which returns a
+    (model, metadata) tuple. When the loaded models exceed ``max_bytes``, the least
+    recently used ones that are not pinned are unloaded. Concurrent requests for a
+    language that is not loaded yet wait for a single load.
+    """
+
+    def __init__(self, loader, max_bytes: int, pinned=()):
+        self._loader = loader
+        self._max_bytes = max_bytes
+        self._pinned = set(pinned)
+        self._lock = Lock()
+        # language -> (model, metadata, size in bytes), in LRU order.
+        self._models = OrderedDict()
+        self._load_locks = {}
+        self._stats = {}
+
+    def _lookup(self, language: str):
+        entry = self._models.get(language)
+        if entry is not None:
+            self._models.move_to_end(language)
+            self._stats[language]["hits"] += 1
+        return entry
+
+    def get(self, language: str):
+        with self._lock:
+            entry = self._lookup(language)
+            if entry is None:
+                load_lock = self._load_locks.setdefault(language, Lock())
+        if entry is None:
+            with load_lock:
+                with self._lock:
+                    entry = self._lookup(language)
+                if entry is None:
+                    entry = self._load(language)
+        return entry[0], entry[1]
+
+    def _load(self, language: str):
+        import torch
+
+        start = time.time()
+        model, metadata = self._loader(language)
+        load_seconds = time.time() - start
+        size = sum(
+            t.element_size() * t.nelement()
+            for t in itertools.chain(model.parameters(), model.buffers())
+        )
+        with self._lock:
+            self._models[language] = (model, metadata, size)
+            stats = self._stats.setdefault(
+                language, {"hits": 0, "loads": 0, "evictions": 0}
+            )
+            stats["loads"] += 1
+            stats["load_seconds"] = round(load_seconds, 3)
+            stats["size_bytes"] = size
+            total = sum(entry[2] for entry in self._models.values())
+            for other in list(self._models):
+                if total <= self._max_bytes:
+                    break
+                if other == language or other in self._pinned:
+                    continue
+                logger.info(f"Unloading alignment model for {other}.")
+                total -= self._models.pop(other)[2]
+                self._stats[other]["evictions"] += 1
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return model, metadata, size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "budget_bytes": self._max_bytes,
+                "resident_bytes": sum(entry[2] for entry in self._models.values()),
+                "languages": {
+                    language: dict(
+                        stats,
+                        loaded=language in self._models,
+                        pinned=language in self._pinned,
+                    )
+                    for language, stats in self._stats.items()
+                },
+            }
+
+
+class _StageCache:
+    """
+    Caches the pickled output of each pipeline stage under a hash of its inputs (see
+    key), so that a stage that already ran for a recording is not run again.
+
+    Recent outputs are held in memory, up to ``max_memory_bytes`` in total. With a
+    ``folder``, every output is also stored as a file named after its key, and the
+    least recently used files are removed once the folder holds more than
+    ``max_disk_bytes``. Replicas that mount the same folder share their outputs:
+    on a memory miss the file is opened directly, whichever replica wrote it. The
+    folder is rescanned at most ``SCAN_INTERVAL`` seconds before evicting, so that
+    the budget counts the files of all replicas rather than only this one's.
+    """
+
+    SCAN_INTERVAL = 60
+
+    def __init__(
+        self,
+        max_memory_bytes: int,
+        folder: Optional[str] = None,
+        max_disk_bytes: int = 0,
+    ):
+        self._lock = Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._max_memory_bytes = max_memory_bytes
+        self._folder = folder
+        self._max_disk_bytes = max_disk_bytes
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._scanned_at = 0.0
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+            self._scan()
+
+    def _scan(self):
+        """
+        Rebuilds the index of the folder, least recently used first, including
+        the entries written by other replicas.
+        """
+        entries = []
+        for entry in os.scandir(self._folder):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Evicted by another replica in the meantime.
+                continue
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        disk = OrderedDict((name, size) for _, name, size in sorted(entries))
+        with self._lock:
+            self._disk = disk
+            self._disk_bytes = sum(disk.values())
+            self._scanned_at = time.time()
+
+    @staticmethod
+    def key(spec: dict) -> str:
+        return hashlib.sha256(
+            json.dumps(spec, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return self._memory[key]
+        if self._folder:
+            # The file is looked up even if it is not in the index, as another
+            # replica sharing the folder may have written it since the last scan.
+            path = os.path.join(self._folder, key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                with self._lock:
+                    self._disk_bytes -= self._disk.pop(key, 0)
+            else:
+                with self._lock:
+                    self._disk_bytes += len(data) - self._disk.pop(key, 0)
+                    self._disk[key] = len(data)
+                    self._counters["disk_hits"] += 1
+                self._put_memory(key, data)
+                return data
+        with self._lock:
+            self._counters["misses"] += 1
+        return None
+
+    def put(self, key: str, data: bytes):
+        self._put_memory(key, data)
+        if not self._folder or len(data) > self._max_disk_bytes:
+            return
+        path = os.path.join(self._folder, key)
+        # Write to a temp file first so readers never see partial files. The name
+        # is unique, as other replicas may write the same entry at the same time.
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Cannot write stage cache entry {path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        if time.time() - self._scanned_at > self.SCAN_INTERVAL:
+            self._scan()
+        evicted = []
+        with self._lock:
+            self._disk_bytes += len(data) - self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            while self._disk_bytes > self._max_disk_bytes:
+                name, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(name)
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self._folder, name))
+            except OSError:
+                pass
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self._max_memory_bytes:
+            return
+        with self._lock:
+            self._memory_bytes += len(data) - len(self._memory.pop(key, b""))
+            self._memory[key] = data
+            while self._memory_bytes > self._max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._counters,
+                memory_entries=len(self._memory),
+                memory_bytes=self._memory_bytes,
+                disk_entries=len(self._disk),
+                disk_bytes=self._disk_bytes,
+            )
+
+
+class _JobCancelled(Exception):
+    pass
+
+
+class _Job:
+    """
+    The state of an asynchronous job, see WhisperX.submit. ``stage`` is the stage the
+    job is currently in, and ``progress`` the fraction of the audio transcribed.
+    """
+
+    def __init__(self, params: dict):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = "queued"
+        self.stage = None
+        self.progress = 0.0
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress, 3),
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
 class WhisperX(Photon):
     """
     A WhisperX photon that serves the [WhisperX](https://github.com/m-bain/whisperX) model.
 
-    The photon exposes a single endpoint "/run" that takes an audio file as input, and returns
-    the transcription, and alignment, and diarization results.
+    The photon exposes the following endpoints:
+    - "/run" takes an audio file as input, and returns the transcription, and alignment,
+      and diarization results.
+    - "/run_stream" transcribes audio of any length while decoding it, and streams the
+      segments back as they are transcribed.
+    - "/submit", "/status", "/result" and "/cancel" run the same pipeline as "/run" as
+      an asynchronous job, independent of the client connection.
+    - "/transcribe_stats", "/alignment_stats" and "/cache_stats" report on the shared
+      transcription batches, the loaded alignment models, and the stage cache, and
+      "/model" returns the whisper model in use.
     """
 
     # Note: openai-whisper implicitly requires triton 2.1.0, which in turn might be in conflict
@@ -46,6 +569,10 @@ class WhisperX(Photon):
             # 10 minutes. If you are deploying things on your own, you can change
             # it to be longer.
             "MAX_LENGTH_IN_SECONDS": "600",
+            # memory budget for the alignment models. Models of the languages in
+            # ALIGNMENT_LANGUAGE_TO_KEEP are always loaded, other languages are loaded
+            # on demand and unloaded (least recently used first) to stay within it.
+            "ALIGNMENT_MEMORY_BUDGET_MB": "4096",
         },
         "secret": [
             "HUGGING_FACE_HUB_TOKEN",
@@ -57,15 +584,34 @@ class WhisperX(Photon):
     SUPPORTED_LANGUAGES = {"en", "fr", "de", "es", "it", "ja", "zh", "nl", "uk", "pt"}
     # The main language for the model
     MAIN_LANGUAGE = "en"
-    # batch size that is benchmarked to be the best balance on A10
+    # batch size that is benchmarked to be the best balance on A10. Batches are
+    # formed from the segments of all concurrent requests, see _SegmentBatcher.
     DEFAULT_BATCH_SIZE = 16
+    # The number of segments a single request may have waiting in the batcher. Two
+    # batches are enough to keep the model busy, and bound the memory a long
+    # recording takes for its log-mel features.
+    MAX_PENDING_SEGMENTS = 2 * DEFAULT_BATCH_SIZE
 
     # Because each alignment language takes a nontrivial amount of memory,
     # we only keep languages that we find are commonly called, and load other
-    # models on-demand. You can change this to host more alignment models in a
-    # warm state at the cost of more memory.
+    # models on-demand, keeping them as long as they fit in ALIGNMENT_MEMORY_BUDGET_MB.
+    # You can change this to host more alignment models in a warm state at the cost
+    # of more memory.
     ALIGNMENT_LANGUAGE_TO_KEEP = {"en", "zh", "es"}
 
+    DIARIZATION_MODEL = "pyannote/speaker-diarization@2.1"
+
+    # run_stream transcribes the audio in windows of about STREAM_WINDOW_SECONDS. Each
+    # window is cut at the quietest point of its last STREAM_CUT_SECONDS, so that a
+    # cut rarely falls into the middle of a word.
+    STREAM_WINDOW_SECONDS = 30
+    STREAM_CUT_SECONDS = 5
+    # See init.
+    JOB_HEARTBEAT_SECONDS = 60
+
+    # ffmpeg gives up on a url that neither sends nor accepts data for this long.
+    STREAM_IO_TIMEOUT_SECONDS = 30
+
     def init(self):
         import torch
         import whisperx
@@ -110,57 +656,173 @@ class WhisperX(Photon):
         # For the main model, inference is not thread safe (because of some underlying cuda memory
         # accesses). As a result, whenever we use the transcribe model, we need to lock it.
         self.transcribe_model_lock = Lock()
+        # Instead of transcribing one request at a time, requests only run voice activity
+        # detection themselves, and the speech segments of all requests are transcribed
+        # together in shared batches.
+        self._vad_lock = Lock()
+        self._tokenizers = {}
+        self._batcher = _SegmentBatcher(
+            self._transcribe_batch, max_batch_size=self.DEFAULT_BATCH_SIZE
+        )
 
         # 2. load whisper align model. Alignment models are language specific, so we will basically
-        # load them as a dictionary. In addition, we only load models that are in ALIGNMENT_LANGUAGE_TO_KEEP.
-        self._model_a = {}
-        self._metadata = {}
-        for lang in self.ALIGNMENT_LANGUAGE_TO_KEEP:
-            self._model_a[lang], self._metadata[lang] = whisperx.load_align_model(
+        # keep them in a pool keyed by language. We preload the models in ALIGNMENT_LANGUAGE_TO_KEEP,
+        # which are never unloaded, and the pool loads others when they are first needed.
+        self._align_models = _AlignModelPool(
+            lambda lang: whisperx.load_align_model(
                 language_code=lang, device=self.device
-            )
+            ),
+            int(os.environ.get("ALIGNMENT_MEMORY_BUDGET_MB", 4096)) * 2**20,
+            pinned=self.ALIGNMENT_LANGUAGE_TO_KEEP,
+        )
+        for lang in self.ALIGNMENT_LANGUAGE_TO_KEEP:
+            self._align_models.get(lang)
         # Since we don't know if whisper's align function is perfectly thread safe or not, we
         # will lock it as well.
         self.align_model_lock = Lock()
 
         # 3. load whisper diarize model. Diarization model right now is thread safe.
         self._diarize_model = whisperx.DiarizationPipeline(
-            model_name="pyannote/speaker-diarization@2.1",
+            model_name=self.DIARIZATION_MODEL,
             use_auth_token=self.hf_token,
             device=self.device,
         )
         self._diarize_model_lock = Lock()
 
+        # Alignment needs the transcription, but diarization only needs the audio. Full
+        # pipeline requests therefore run diarization on this pool, concurrently with
+        # transcription and alignment.
+        self._stage_pool = ThreadPoolExecutor(max_workers=self.handler_max_concurrency)
+
+        # Clients often send the same recording again with different flags, e.g. first
+        # transcribe_only and then the full pipeline. The output of every stage is cached,
+        # keyed by a hash of the decoded audio and the stage parameters, so that only the
+        # missing stages run. The cache is kept in memory (STAGE_CACHE_MB), and optionally
+        # in STAGE_CACHE_FOLDER (bounded by STAGE_CACHE_DISK_MB), which replicas can share
+        # by mounting the same storage.
+        self._stage_cache = _StageCache(
+            max_memory_bytes=int(os.environ.get("STAGE_CACHE_MB", 256)) * 2**20,
+            folder=os.environ.get("STAGE_CACHE_FOLDER"),
+            max_disk_bytes=int(os.environ.get("STAGE_CACHE_DISK_MB", 4096)) * 2**20,
+        )
+
+        # Asynchronous jobs (see submit) run on a pool of JOB_WORKERS threads, independent
+        # of client connections. The most recent MAX_JOBS jobs are kept in memory. Queued
+        # jobs hold their input in memory, so at most MAX_QUEUED_JOBS can wait for a
+        # worker. If JOB_FOLDER is set, job states and results are also written there,
+        # so that they can be queried from any replica mounting the same storage. The
+        # files of unfinished jobs are touched every JOB_HEARTBEAT_SECONDS, so that jobs
+        # whose replica went away can be told apart, see _get_job.
+        self._jobs = OrderedDict()
+        self._jobs_lock = Lock()
+        self._max_jobs = int(os.environ.get("MAX_JOBS", 1000))
+        self._max_queued_jobs = int(os.environ.get("MAX_QUEUED_JOBS", 32))
+        self._job_folder = os.environ.get("JOB_FOLDER")
+        if self._job_folder:
+            os.makedirs(self._job_folder, exist_ok=True)
+            Thread(target=self._job_heartbeat, daemon=True).start()
+        self._job_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("JOB_WORKERS", 2))
+        )
+
     def _transcribe(
-        self, audio: np.ndarray, audio_file, language: Optional[str] = None
+        self,
+        audio: np.ndarray,
+        audio_file,
+        language: Optional[str] = None,
+        progress=None,
+        background: bool = False,
     ):
-        logger.debug("transcribe: aquiring lock")
-        with self.transcribe_model_lock:
-            logger.debug("transcribe: lock acquired")
-            if language == self.MAIN_LANGUAGE:
-                result = self._main_model.transcribe(
-                    audio, batch_size=self.DEFAULT_BATCH_SIZE, language=language
-                )
-            else:
-                result = self._multilingual_model.transcribe(
-                    audio, batch_size=self.DEFAULT_BATCH_SIZE, language=language
+        # This follows FasterWhisperPipeline.transcribe, except that the segments are
+        # transcribed by the shared batcher instead of a per-request pipeline call.
+        import torch
+        from whisperx.audio import N_SAMPLES, SAMPLE_RATE, log_mel_spectrogram
+        from whisperx.vad import merge_chunks
+
+        with self._vad_lock:
+            vad_segments = self._main_model.vad_model({
+                "waveform": torch.from_numpy(audio).unsqueeze(0),
+                "sample_rate": SAMPLE_RATE,
+            })
+        vad_segments = merge_chunks(
+            vad_segments,
+            30,
+            onset=self._main_model._vad_params["vad_onset"],
+            offset=self._main_model._vad_params["vad_offset"],
+        )
+        if language is None:
+            with self.transcribe_model_lock:
+                language = self._multilingual_model.detect_language(audio)
+
+        n_mels = self._main_model.model.feat_kwargs.get("feature_size") or 80
+        # The features of a segment are only computed once there is room for it in
+        # the batcher (see MAX_PENDING_SEGMENTS).
+        futures = deque()
+        texts = []
+
+        def wait_oldest():
+            segment, future = futures.popleft()
+            texts.append(future.result())
+            if progress is not None:
+                progress(min(segment["end"] * SAMPLE_RATE / len(audio), 1.0))
+
+        try:
+            for segment in vad_segments:
+                if len(futures) >= self.MAX_PENDING_SEGMENTS:
+                    wait_oldest()
+                start = int(segment["start"] * SAMPLE_RATE)
+                chunk = audio[start : int(segment["end"] * SAMPLE_RATE)]
+                features = log_mel_spectrogram(
+                    chunk, n_mels=n_mels, padding=N_SAMPLES - chunk.shape[0]
                 )
-        logger.debug("transcribe: lock released")
-        return result
+                futures.append((
+                    segment,
+                    self._batcher.submit(language, features.numpy(), background),
+                ))
+            while futures:
+                wait_oldest()
+        finally:
+            # If we are interrupted, don't spend GPU time on the remaining segments.
+            for _, future in futures:
+                future.cancel()
+        return {
+            "segments": [
+                {
+                    "text": text,
+                    "start": round(segment["start"], 3),
+                    "end": round(segment["end"], 3),
+                }
+                for segment, text in zip(vad_segments, texts)
+            ],
+            "language": language,
+        }
+
+    def _transcribe_batch(self, language: str, features: List[np.ndarray]):
+        import faster_whisper
+
+        model = self._main_model.model
+        # Tokenizers only depend on the language, and are only used by the batcher
+        # thread, so we simply keep them around.
+        if language not in self._tokenizers:
+            self._tokenizers[language] = faster_whisper.tokenizer.Tokenizer(
+                model.hf_tokenizer,
+                model.model.is_multilingual,
+                task="transcribe",
+                language=language,
+            )
+        with self.transcribe_model_lock:
+            return model.generate_segment_batched(
+                np.stack(features),
+                self._tokenizers[language],
+                self._main_model.options,
+            )
 
     def _align(self, result, audio):
         # Run alignment
         import whisperx
 
         logger.debug("Start alignment")
-        if result["language"] in self.SUPPORTED_LANGUAGES:
-            model_a = self._model_a[result["language"]]
-            metadata_a = self._metadata[result["language"]]
-        else:
-            # load model_a and metadata on-demand
-            model_a, metadata_a = whisperx.load_align_model(
-                language_code=result["language"], device=self.device
-            )
+        model_a, metadata_a = self._align_models.get(result["language"])
         with self.align_model_lock:
             result = whisperx.align(
                 result["segments"],
@@ -173,17 +835,229 @@ class WhisperX(Photon):
         logger.debug("alignment done.")
         return result
 
-    def _diarize(self, audio, min_speakers, max_speakers):
-        logger.debug("Start diarization")
-        with self._diarize_model_lock:
-            result = self._diarize_model(
-                audio,
-                min_speakers=min_speakers,
-                max_speakers=max_speakers,
+    def _check_request(
+        self,
+        language: Optional[str],
+        min_speakers: Optional[int],
+        max_speakers: Optional[int],
+    ):
+        self._check_language(language)
+        if min_speakers is not None and min_speakers < 1:
+            raise HTTPException(400, f"min_speakers must be >= 1, got {min_speakers}")
+        if max_speakers is not None and max_speakers < 1:
+            raise HTTPException(400, f"max_speakers must be >= 1, got {max_speakers}")
+        if (
+            min_speakers is not None
+            and max_speakers is not None
+            and min_speakers > max_speakers
+        ):
+            raise HTTPException(
+                400,
+                f"min_speakers must be <= max_speakers, got {min_speakers} >"
+                f" {max_speakers}",
             )
+
+    def _check_language(self, language: Optional[str]):
+        if language is not None and language not in self.SUPPORTED_LANGUAGES:
+            raise HTTPException(
+                400,
+                f"Unsupported language: {language}. Supported languages:"
+                f" {self.SUPPORTED_LANGUAGES}",
+            )
+
+    def _load_audio(self, input: Union[FileParam, str]) -> np.ndarray:
+        """
+        Decodes the whole input into 16kHz mono audio. The upload is decoded from
+        memory, without writing it to a temporary file first.
+        """
+        from whisperx.audio import SAMPLE_RATE
+
+        try:
+            return decode_audio(get_file_content(input), SAMPLE_RATE)
+        except RuntimeError as e:
+            raise HTTPException(400, f"Cannot decode audio: {e}")
+
+    def _audio_windows(self, input: Union[FileParam, str]):
+        """
+        Decodes the input incrementally with ffmpeg, and yields (offset, audio) tuples
+        of consecutive windows of 16kHz mono audio, offset being the index of the
+        first sample of the window. Only one window is held in memory at a time, so
+        the length of the input is not limited. If ffmpeg fails, RuntimeError is
+        raised after the windows it did decode.
+        """
+        # Urls are streamed by ffmpeg itself, so decoding starts right away.
+        if isinstance(input, str) and input.startswith(("http://", "https://")):
+            timeout = str(self.STREAM_IO_TIMEOUT_SECONDS * 1000000)
+            yield from self._decode_windows(["-rw_timeout", timeout, "-i", input])
+            return
+        # Other inputs are piped into ffmpeg, unless it needs to seek in them, see
+        # decode_audio.
+        content = get_file_content(input)
+        if not _is_iso_bmff(content):
+            windows = self._decode_windows(["-i", "pipe:0"], content)
+            try:
+                first = next(windows, None)
+            except RuntimeError as e:
+                logger.debug(f"Retrying to decode from a file: {e}")
+            else:
+                if first is not None:
+                    yield first
+                yield from windows
+                return
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            yield from self._decode_windows(["-i", f.name])
+
+    def _decode_windows(self, source: List[str], content: Optional[bytes] = None):
+        """
+        Runs ffmpeg on the source arguments, piping in content if given, and yields
+        the windows of its output, see _audio_windows.
+        """
+        from whisperx.audio import SAMPLE_RATE
+
+        # This is the same conversion as whisperx.load_audio. ffmpeg skips over
+        # data it cannot decode, and treats a timeout as the end of the input, with
+        # a successful exit status either way: -xerror makes it fail instead, so
+        # that a truncated result does not pass for a complete one.
+        process = subprocess.Popen(
+            ["ffmpeg", "-xerror", "-threads", "0"]
+            + source
+            + ["-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le"]
+            + ["-ar", str(SAMPLE_RATE), "-loglevel", "error", "-"],
+            stdin=subprocess.DEVNULL if content is None else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if content is not None:
+            _feed_stdin(process, content)
+        error = _drain_stderr(process)
+
+        window = self.STREAM_WINDOW_SECONDS * SAMPLE_RATE
+        cut_region = self.STREAM_CUT_SECONDS * SAMPLE_RATE
+        frame = SAMPLE_RATE // 10
+        buffer = np.zeros(0, dtype=np.float32)
+        offset = 0
+        try:
+            while True:
+                wanted = 2 * (window - len(buffer))
+                data = process.stdout.read(wanted)
+                samples = np.frombuffer(data[: len(data) // 2 * 2], np.int16)
+                buffer = np.concatenate([buffer, samples.astype(np.float32) / 32768.0])
+                if len(data) < wanted:
+                    break
+                # Cut at the center of the 100ms frame with the least energy.
+                region = buffer[-cut_region:].reshape(-1, frame)
+                quietest = int(np.argmin(np.square(region).mean(axis=1)))
+                cut = len(buffer) - cut_region + quietest * frame + frame // 2
+                yield offset, buffer[:cut]
+                offset += cut
+                buffer = buffer[cut:]
+            if len(buffer):
+                yield offset, buffer
+            if process.wait() != 0:
+                raise RuntimeError(
+                    f"ffmpeg exited with status {process.returncode}: {error()}"
+                )
+        finally:
+            process.kill()
+            process.wait()
+
+    def _spool_audio(self, input: Union[FileParam, str], report) -> np.ndarray:
+        """
+        Decodes the input window by window (see _audio_windows) into a temporary file,
+        and returns the audio memory-mapped from it. Jobs have no length limit: this
+        way the decoded audio is never held in memory as a whole, and the pages the
+        stages are not working on can be dropped by the kernel. report("decode") is
+        called after every window, and may raise to abort decoding.
+        """
+        with tempfile.TemporaryFile() as f:
+            for _, window in self._audio_windows(input):
+                f.write(window)
+                report("decode")
+            if f.tell() == 0:
+                return np.zeros(0, dtype=np.float32)
+            # Copy-on-write, so that the stages get a writable array, as they would
+            # from decode_audio. The mapping outlives the (already unlinked) file.
+            return np.memmap(f, dtype=np.float32, mode="c")
+
+    def _cached(self, spec: dict, hits: list, fn, *args, **kwargs):
+        """
+        Returns the cached output of the stage described by spec, or runs
+        fn(*args, **kwargs) and caches its output. The stage name is appended to hits
+        on a cache hit.
+        """
+        result = self._cache_lookup(spec, hits)
+        if result is None:
+            result = fn(*args, **kwargs)
+            self._stage_cache.put(_StageCache.key(spec), pickle.dumps(result))
+        return result
+
+    def _cache_lookup(self, spec: dict, hits: list):
+        """
+        Returns the cached output of the stage described by spec, or None, see _cached.
+        """
+        data = self._stage_cache.get(_StageCache.key(spec))
+        if data is None:
+            return None
+        hits.append(spec["stage"])
+        return pickle.loads(data)
+
+    @staticmethod
+    def _timed(timings: dict, stage: str, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs), recording its wall clock time in timings[stage].
+        """
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[stage] = round(time.time() - start, 3)
+
+    def _diarize(self, audio, min_speakers, max_speakers, stopped=lambda: False):
+        # Diarization runs on the stage pool, possibly waiting for the model behind
+        # other requests. Once stopped() returns True, nobody needs the result anymore,
+        # so it gives up its place, or stops if it is already running.
+        while not self._diarize_model_lock.acquire(timeout=1.0):
+            if stopped():
+                raise CancelledError()
+        try:
+            logger.debug("Start diarization")
+            result = self._run_diarize_model(audio, min_speakers, max_speakers, stopped)
+        finally:
+            self._diarize_model_lock.release()
         logger.debug("diarization done.")
         return result
 
+    def _run_diarize_model(self, audio, min_speakers, max_speakers, stopped):
+        """
+        The same as calling whisperx's DiarizationPipeline, except that the pyannote
+        pipeline gets a hook, which it calls between its steps and batches, that
+        stops it once stopped() returns True.
+        """
+        import pandas as pd
+        import torch
+        from whisperx.audio import SAMPLE_RATE
+
+        def hook(*args, **kwargs):
+            if stopped():
+                raise CancelledError()
+
+        hook()
+        segments = self._diarize_model.model(
+            {"waveform": torch.from_numpy(audio[None, :]), "sample_rate": SAMPLE_RATE},
+            min_speakers=min_speakers,
+            max_speakers=max_speakers,
+            hook=hook,
+        )
+        diarize_df = pd.DataFrame(
+            segments.itertracks(yield_label=True),
+            columns=["segment", "label", "speaker"],
+        )
+        diarize_df["start"] = diarize_df["segment"].apply(lambda x: x.start)
+        diarize_df["end"] = diarize_df["segment"].apply(lambda x: x.end)
+        return diarize_df
+
     @Photon.handler(
         example={
             "input": (
@@ -201,7 +1075,8 @@ class WhisperX(Photon):
         min_speakers: Optional[int] = None,
         max_speakers: Optional[int] = None,
         transcribe_only: bool = True,
-    ) -> List:
+        return_metadata: bool = False,
+    ) -> Union[List, dict]:
         """
         Runs transcription, alignment, and diarization for the input.
 
@@ -215,39 +1090,23 @@ class WhisperX(Photon):
             - max_speakers(optional): the hint for maximum number of speakers for diarization.
             - transcribe_only(optional): if True, only transcribe the audio, and skip alignment
                 and diarization. Default to True.
+            - return_metadata(optional): if True, return a dict with the result as "segments",
+                and "metadata" with the language, the time spent in each stage in seconds, and
+                the stages that were served from the cache. Diarization runs concurrently with
+                transcription and alignment, so the stage times may add up to more than the
+                total.
 
         - Returns:
             - result: The transcribe and/or aligned and diarized result. If transcribe_only,
                 the result contains only the transcription
         """
-        import whisperx
-
         # Check input
-        if language is not None and language not in self.SUPPORTED_LANGUAGES:
-            raise HTTPException(
-                400,
-                f"Unsupported language: {language}. Supported languages:"
-                f" {self.SUPPORTED_LANGUAGES}",
-            )
-        if min_speakers is not None and min_speakers < 1:
-            raise HTTPException(400, f"min_speakers must be >= 1, got {min_speakers}")
-        if max_speakers is not None and max_speakers < 1:
-            raise HTTPException(400, f"max_speakers must be >= 1, got {max_speakers}")
-        if (
-            min_speakers is not None
-            and max_speakers is not None
-            and min_speakers > max_speakers
-        ):
-            raise HTTPException(
-                400,
-                f"min_speakers must be <= max_speakers, got {min_speakers} >"
-                f" {max_speakers}",
-            )
+        self._check_request(language, min_speakers, max_speakers)
 
         start_time = time.time()
+        timings = {}
         logger.debug(f"Start processing audio {input}")
-        audio_file = get_file_content(input, return_file=True)
-        audio = whisperx.load_audio(audio_file.name)
+        audio = self._timed(timings, "decode", self._load_audio, input)
         if audio.size > self.MAX_LENGTH_IN_SECONDS * 16000:
             raise HTTPException(
                 400,
@@ -255,42 +1114,503 @@ class WhisperX(Photon):
                 f" allowed length {self.MAX_LENGTH_IN_SECONDS} seconds.",
             )
         logger.debug(f"started processing audio of length {len(audio)}.")
-        # Note: audio_file is basically provided so we can run whisper if needed. Whisper
-        # uses a different loading mechanism, and as a result it is slightly different from
-        # the whisperx loaded audio.
-        result = self._transcribe(audio, audio_file, language=language)
-        logger.debug("Transcription done.")
-
-        if len(result["segments"]) == 0:
-            logger.debug("Empty result from whisperx. Directly return empty.")
-            return []
-
-        if transcribe_only:
-            total_time = time.time() - start_time
-            logger.debug(
-                f"finished processing audio of len {audio.size}. Total"
-                f" time: {total_time} ({audio.size / 16000 / total_time} x realtime)"
-            )
+        result, cached = self._pipeline(
+            audio,
+            language,
+            min_speakers,
+            max_speakers,
+            transcribe_only,
+            timings,
+        )
+        total_time = time.time() - start_time
+        logger.debug(
+            f"finished processing audio of len {audio.size}. Total"
+            f" time: {total_time} ({audio.size / 16000 / total_time} x realtime)"
+        )
+        if not return_metadata:
             return result["segments"]
+        timings["total"] = round(total_time, 3)
+        return self._response(result, timings, cached)
+
+    @staticmethod
+    def _response(result, timings: dict, cached: list) -> dict:
+        return {
+            "segments": result["segments"],
+            "metadata": {
+                "language": result["language"],
+                "timings": timings,
+                "cached": cached,
+            },
+        }
+
+    def _pipeline(
+        self,
+        audio: np.ndarray,
+        language: Optional[str],
+        min_speakers: Optional[int],
+        max_speakers: Optional[int],
+        transcribe_only: bool,
+        timings: dict,
+        report=None,
+        background: bool = False,
+    ):
+        """
+        Runs transcription and, unless transcribe_only, alignment and diarization on the
+        decoded audio. Returns the result and the list of stages served from the cache,
+        and records the time spent in each stage in timings. If given, report(stage,
+        progress) is called when a stage starts, and with the fraction of the audio
+        transcribed during transcription. It may raise to abort the pipeline. With
+        background, the segments are transcribed at a lower priority than those of
+        other requests (see _SegmentBatcher).
+        """
+        import whisperx
+
+        report = report or (lambda stage, progress=None: None)
+        # The stage outputs are cached by the content of the decoded audio, so the same
+        # recording hits the cache whether it is sent as a url or as a file.
+        audio_hash = hashlib.blake2b(audio.data, digest_size=16).hexdigest()
+        cached = []
+        transcribe_spec = {
+            "stage": "transcribe",
+            "audio": audio_hash,
+            "model": self.WHISPER_MODEL,
+            "language": language,
+        }
+        # Set when the pipeline returns or raises, see _diarize.
+        stopped = Event()
+
+        def transcribe(result):
+            if result is not None:
+                return result
+            # Note: the audio is decoded from memory, so there is no audio file to pass
+            # along to whisper.
+            result = self._transcribe(
+                audio,
+                None,
+                language=language,
+                progress=lambda progress: report("transcribe", progress),
+                background=background,
+            )
+            self._stage_cache.put(
+                _StageCache.key(transcribe_spec), pickle.dumps(result)
+            )
+            return result
+
+        def align(result):
+            return self._cached(
+                {
+                    "stage": "align",
+                    "audio": audio_hash,
+                    "model": self.WHISPER_MODEL,
+                    "language": result["language"],
+                },
+                cached,
+                self._align,
+                result,
+                audio,
+            )
+
+        # Diarization may still be running on the stage pool after an early return,
+        # so it records its time and cache hit separately. They only become part of
+        # the response once it has been joined.
+        diarize_timings, diarize_cached = {}, []
+
+        def diarize():
+            return self._cached(
+                {
+                    "stage": "diarize",
+                    "audio": audio_hash,
+                    "model": self.DIARIZATION_MODEL,
+                    "min_speakers": min_speakers,
+                    "max_speakers": max_speakers,
+                },
+                diarize_cached,
+                self._diarize,
+                audio,
+                min_speakers,
+                max_speakers,
+                stopped.is_set,
+            )
+
+        # Diarization is independent of the transcription until we assign speakers to
+        # words, so we start it right away, and join it at the end. That is, unless
+        # the transcription is cached and empty, so that nothing needs speakers.
+        result = self._cache_lookup(transcribe_spec, cached)
+        diarize_future = None
+        if not transcribe_only and (result is None or result["segments"]):
+            diarize_future = self._stage_pool.submit(
+                self._timed, diarize_timings, "diarize", diarize
+            )
+
+        try:
+            report("transcribe", 0.0)
+            result = self._timed(timings, "transcribe", transcribe, result)
+            report("transcribe", 1.0)
+            logger.debug("Transcription done.")
+
+            if len(result["segments"]) == 0:
+                logger.debug("Empty result from whisperx. Directly return empty.")
+                return result, cached
+
+            if transcribe_only:
+                return result, cached
+
+            # Run alignment, while diarization finishes on the stage pool.
+            report("align")
+            language = result["language"]
+            result = self._timed(timings, "align", align, result)
+            result["language"] = language
+
+            # When there is no active diarization, the diarize model throws a KeyError.
+            # In this case, we simply skip diarization.
+            report("diarize")
+            while not diarize_future.done():
+                # report may abort the pipeline, e.g. for a cancelled job, which also
+                # stops the diarization.
+                wait([diarize_future], timeout=1.0)
+                report("diarize")
+            try:
+                diarize_segments = diarize_future.result()
+            except Exception as e:
+                logger.error(f"Error in diarization: {e}. Skipping diarization.")
+                diarize_segments = None
+            # Diarization is joined, so its time and cache hit can be reported.
+            timings.update(diarize_timings)
+            cached.extend(diarize_cached)
+            if diarize_segments is not None:
+                report("assign_speakers")
+                result = self._timed(
+                    timings,
+                    "assign_speakers",
+                    whisperx.assign_word_speakers,
+                    diarize_segments,
+                    result,
+                )
+            return result, cached
+        finally:
+            # Don't diarize if we return early or are aborted.
+            stopped.set()
+            if diarize_future is not None:
+                diarize_future.cancel()
+
+    @Photon.handler(
+        example={
+            "input": (
+                "https://huggingface.co/datasets/Narsil/asr_dummy/resolve/main/1.flac"
+            ),
+            "language": "en",
+        },
+    )
+    def run_stream(
+        self,
+        input: Union[FileParam, str],
+        language: Optional[str] = None,
+    ) -> StreamingResponse:
+        """
+        Transcribes the input while it is being decoded, and streams the transcribed
+        segments back as they finish. Unlike run, the audio is never held in memory as
+        a whole, so there is no limit on its length, and the first segments arrive
+        within seconds even for hour-long recordings.
 
-        # Run alignment and diarization
-        result = self._align(result, audio)
+        - Inputs:
+            - input: same as run. Urls are decoded while they are being downloaded.
+            - language(optional): the language code for the input. If not provided, the
+                language is detected on the first window, and used for the rest.
 
-        # When there is no active diarization, the diarize model throws a KeyError.
-        # In this case, we simply skip diarization.
+        - Returns:
+            - newline delimited JSON, with one transcribed segment ({"text", "start",
+                "end"}) per line. Alignment and diarization need the whole audio, use
+                run for them. If decoding fails after the response has started, e.g.
+                because the input is truncated or its url stops responding, the
+                segments decoded so far are followed by a last {"error"} line.
+        """
+        from whisperx.audio import SAMPLE_RATE
+
+        self._check_language(language)
+        windows = self._audio_windows(input)
+        # Decode the first window before responding, so that undecodable inputs get
+        # a proper error instead of an empty stream.
         try:
-            diarize_segments = self._diarize(audio, min_speakers, max_speakers)
+            first = next(windows, None)
         except Exception as e:
-            logger.error(f"Error in diarization: {e}. Skipping diarization.")
-        else:
-            result = whisperx.assign_word_speakers(diarize_segments, result)
+            raise HTTPException(400, f"Cannot decode audio: {e}")
 
-        total_time = time.time() - start_time
-        logger.debug(
-            f"finished processing audio of len {audio.size}. Total"
-            f" time: {total_time} ({audio.size / 16000 / total_time} x realtime)"
-        )
-        return result["segments"]
+        def segments():
+            nonlocal language
+            try:
+                for offset, audio in itertools.chain([first] if first else [], windows):
+                    result = self._transcribe(audio, None, language=language)
+                    language = language or result["language"]
+                    seconds = offset / SAMPLE_RATE
+                    for segment in result["segments"]:
+                        segment["start"] = round(segment["start"] + seconds, 3)
+                        segment["end"] = round(segment["end"] + seconds, 3)
+                        yield json.dumps(segment) + "\n"
+            except Exception as e:
+                # The status code is already sent, so the client can only tell from
+                # the stream itself that it is incomplete.
+                logger.error(f"Error in streamed transcription: {e}")
+                yield json.dumps({"error": str(e)}) + "\n"
+
+        return StreamingResponse(segments(), media_type="application/x-ndjson")
+
+    @Photon.handler(
+        example={
+            "input": (
+                "https://huggingface.co/datasets/Narsil/asr_dummy/resolve/main/1.flac"
+            ),
+            "language": "en",
+            "transcribe_only": False,
+        },
+    )
+    def submit(
+        self,
+        input: Union[FileParam, str],
+        language: Optional[str] = "en",
+        min_speakers: Optional[int] = None,
+        max_speakers: Optional[int] = None,
+        transcribe_only: bool = True,
+    ) -> dict:
+        """
+        Submits an asynchronous job that runs the same pipeline as run, and returns its
+        status right away. The job runs on a worker pool independent of the client
+        connection, and is not limited by MAX_LENGTH_IN_SECONDS. Poll status with the
+        returned "id" to follow its progress, fetch the output with result, or stop it
+        with cancel.
+
+        The output of each finished stage is kept in the stage cache (on disk if
+        STAGE_CACHE_FOLDER is set), so submitting a job again, e.g. after a restart,
+        only runs the stages that are missing.
+        """
+        self._check_request(language, min_speakers, max_speakers)
+        with self._jobs_lock:
+            queued = sum(j.status == "queued" for j in self._jobs.values())
+        if queued >= self._max_queued_jobs:
+            raise HTTPException(
+                429, f"{queued} jobs are already waiting, try again later."
+            )
+        job = _Job({
+            "input": input,
+            "language": language,
+            "min_speakers": min_speakers,
+            "max_speakers": max_speakers,
+            "transcribe_only": transcribe_only,
+        })
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+            # Forget the oldest finished jobs beyond MAX_JOBS.
+            for job_id in [j.id for j in self._jobs.values() if j.finished]:
+                if len(self._jobs) <= self._max_jobs:
+                    break
+                del self._jobs[job_id]
+                self._remove_job_files(job_id)
+        self._save_job(job)
+        self._job_pool.submit(self._run_job, job)
+        return job.to_dict()
+
+    @Photon.handler
+    def status(self, job_id: str) -> dict:
+        """
+        Returns the status of a job: "status" is one of queued, running, done, failed
+        and cancelled, "stage" the pipeline stage it is in (decode, transcribe, align,
+        diarize or assign_speakers), and "progress" the fraction of the audio that has
+        been transcribed.
+        """
+        return self._get_job(job_id)[0]
+
+    @Photon.handler
+    def result(self, job_id: str) -> dict:
+        """
+        Returns the result of a finished job, in the same format as run with
+        return_metadata=True.
+        """
+        status, result = self._get_job(job_id)
+        if status["status"] != "done":
+            raise HTTPException(
+                409,
+                f"Job {job_id} is {status['status']}"
+                + (f": {status['error']}" if status["error"] else "."),
+            )
+        return result
+
+    @Photon.handler
+    def cancel(self, job_id: str) -> dict:
+        """
+        Cancels a job. A queued job is cancelled right away, a running job stops at the
+        next transcribed segment, stage boundary or diarization batch. Returns the
+        status of the job.
+        """
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise HTTPException(404, f"Job {job_id} not found on this replica.")
+            job.cancel_event.set()
+            if job.status == "queued":
+                job.status = "cancelled"
+                job.finished_at = time.time()
+        self._save_job(job)
+        return job.to_dict()
+
+    def _run_job(self, job: _Job):
+        with self._jobs_lock:
+            if job.status != "queued":
+                return
+            job.status = "running"
+            job.started_at = time.time()
+
+        def report(stage, progress=None):
+            if job.cancel_event.is_set():
+                raise _JobCancelled()
+            if progress is not None:
+                job.progress = progress
+            if stage != job.stage:
+                job.stage = stage
+                self._save_job(job)
+
+        params = job.params
+        start_time = time.time()
+        try:
+            timings = {}
+            report("decode")
+            audio = self._timed(
+                timings, "decode", self._spool_audio, params["input"], report
+            )
+            # The input can be large, and is not needed anymore.
+            params["input"] = None
+            result, cached = self._pipeline(
+                audio,
+                params["language"],
+                params["min_speakers"],
+                params["max_speakers"],
+                params["transcribe_only"],
+                timings,
+                report,
+                background=True,
+            )
+            timings["total"] = round(time.time() - start_time, 3)
+            job.result = self._response(result, timings, cached)
+            status = "done"
+        except _JobCancelled:
+            status = "cancelled"
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            job.error = str(e)
+            status = "failed"
+        with self._jobs_lock:
+            job.params = None
+            job.status = status
+            job.finished_at = time.time()
+        self._save_job(job)
+
+    def _job_path(self, job_id: str, suffix: str) -> str:
+        if not all(c in "0123456789abcdef" for c in job_id):
+            raise HTTPException(400, f"Invalid job id {job_id}.")
+        return os.path.join(self._job_folder, job_id + suffix)
+
+    def _save_job(self, job: _Job):
+        if not self._job_folder:
+            return
+        # The result is written before the status, so that a job that is done always
+        # has its result. Files are replaced atomically, so readers on other replicas
+        # never see partial files. The worker and the cancel handler may save the same
+        # job at the same time, so every save writes to a temp file of its own.
+        files = [(".json", job.to_dict())]
+        if job.result is not None:
+            files.insert(0, (".result.json", job.result))
+        for suffix, content in files:
+            path = self._job_path(job.id, suffix)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(content, f)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Cannot save job {job.id}: {e}")
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                return
+
+    def _job_heartbeat(self):
+        while True:
+            time.sleep(self.JOB_HEARTBEAT_SECONDS)
+            with self._jobs_lock:
+                unfinished = [job.id for job in self._jobs.values() if not job.finished]
+            for job_id in unfinished:
+                try:
+                    os.utime(self._job_path(job_id, ".json"))
+                except OSError:
+                    pass
+
+    def _remove_job_files(self, job_id: str):
+        if not self._job_folder:
+            return
+        for suffix in (".json", ".result.json"):
+            try:
+                os.remove(self._job_path(job_id, suffix))
+            except OSError:
+                pass
+
+    def _get_job(self, job_id: str):
+        """
+        Returns the status and (if done) the result of a job, from memory or, for jobs
+        of other replicas or from before a restart, from JOB_FOLDER. An unfinished job
+        whose file has not been touched for a few heartbeats was lost with its replica,
+        e.g. in a restart, and is reported as failed.
+        """
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.to_dict(), job.result
+        if self._job_folder:
+            try:
+                path = self._job_path(job_id, ".json")
+                with open(path) as f:
+                    status = json.load(f)
+                    age = time.time() - os.fstat(f.fileno()).st_mtime
+                if (
+                    status["status"] in ("queued", "running")
+                    and age > 5 * self.JOB_HEARTBEAT_SECONDS
+                ):
+                    status.update(
+                        status="failed",
+                        error="The replica running the job stopped, submit it again.",
+                    )
+                result = None
+                if status["status"] == "done":
+                    with open(self._job_path(job_id, ".result.json")) as f:
+                        result = json.load(f)
+                return status, result
+            except (OSError, ValueError):
+                # A file that is not valid JSON, e.g. left by a concurrent save in an
+                # older version, is treated like a missing one.
+                pass
+        raise HTTPException(404, f"Job {job_id} not found.")
+
+    @Photon.handler
+    def transcribe_stats(self) -> dict:
+        """
+        Returns the number of transcribed batches and segments, the mean batch size,
+        and the number of segments of requests and of jobs waiting for a batch.
+        """
+        return self._batcher.stats()
+
+    @Photon.handler
+    def alignment_stats(self) -> dict:
+        """
+        Returns the memory budget of the alignment models and, per language, whether
+        its model is loaded, its size in bytes, how long it took to load, and how often
+        it was loaded, used while loaded, and unloaded.
+        """
+        return self._align_models.stats()
+
+    @Photon.handler
+    def cache_stats(self) -> dict:
+        """
+        Returns the hit/miss counters and the size of the stage cache.
+        """
+        return self._stage_cache.stats()
 
     @Photon.handler
     def model(self) -> str: